@@ -2,15 +2,20 @@
 This tool compare file with gien key values
 Useful to pick eep values.
 '''
+import os
 import tkinter as tk
 from tkinter import filedialog
 from prettytable import PrettyTable
 import MyLibrary
 
 # Create object
-MyLibrary = MyLibrary.MyLibrary()
+MyLibrary = MyLibrary.MyLibrary(cache=MyLibrary.parse_cache, sidecar=True)
 table = PrettyTable()
 
+# Dumps this many times bigger than the key file are only indexed and
+# the keys looked up, instead of parsing every line
+KEY_INDEX_RATIO = 20
+
 
 
 
@@ -43,14 +48,14 @@ class CompareFilesWithGivenKeys:
         '''
         keys, key_value_pair = MyLibrary.read_keys(self.uploaded_file[0])
         table.add_column('Key File', key_value_pair)
+        key_file_size = os.path.getsize(self.uploaded_file[0])
 
         for fl in self.uploaded_file[1:]:
-            pair = MyLibrary.read_key_value_pairs(fl)
-            list_of_pair = []
-
-            for key in keys:
-                if key in pair:
-                    list_of_pair.append(f"{key} : {pair[key]}")
+            if key_file_size * KEY_INDEX_RATIO < os.path.getsize(fl):
+                pair = MyLibrary.read_key_index(fl)
+            else:
+                pair = MyLibrary.read_key_value_table(fl)
+            list_of_pair = list(pair.formatted(keys))
 
             # Add columns to the table
             title = fl.rsplit('/', maxsplit=1)[-1].rsplit('.', maxsplit=1)[0]
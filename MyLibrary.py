@@ -3,10 +3,551 @@ Library for my tool
 Authon: Sayad Hassan
 '''
 
+import bisect
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+
+# NumPy is optional, only needed for KeyValueTable.to_numpy()
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Everything that is not a digit, see MyLibrary.digits()
+_NON_DIGITS = re.compile(r'\D+')
+
+
+# Items measured by _size_of(), the rest is extrapolated
+_SIZE_SAMPLE = 1000
+
+
+def _size_of(result):
+    '''
+    Estimate the memory used by a parse result of strings.
+    '''
+    size = sys.getsizeof(result)
+    if isinstance(result, dict):
+        sample = list(itertools.islice(result.items(), _SIZE_SAMPLE))
+        items = sum(sys.getsizeof(key) + sys.getsizeof(value) for key, value in sample)
+    elif isinstance(result, (list, tuple)):
+        sample = result[:_SIZE_SAMPLE]
+        items = sum(_size_of(item) if isinstance(item, (list, tuple, dict)) else sys.getsizeof(item)
+                    for item in sample)
+    else:
+        return size
+
+    if sample:
+        size += items * len(result) // len(sample)
+    return size
+
+
+class ParseCache:
+    '''
+    Parse results by file, reused while the file keeps its size and
+    modification time. The least recently used results are dropped when
+    the estimated memory use exceeds max_bytes.
+
+    Cached results are shared, do not modify them.
+    '''
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, kind, txt_file, parse):
+        '''
+        Get the cached kind of parse result of txt_file, calling
+        parse(txt_file) when missing or the file has changed.
+
+        :return result: parse result
+        '''
+        stat = os.stat(txt_file)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        key = (kind, os.path.abspath(txt_file))
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+            # Stale, release its mapped sidecar so it can be rewritten
+            if entry is not None:
+                del self._entries[key]
+                self.bytes -= entry[2]
+                close = getattr(entry[1], 'close', None)
+                if close is not None:
+                    close()
+
+        result = parse(txt_file)
+        size = _size_of(result)
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            if size <= self.max_bytes:
+                self._entries[key] = (signature, result, size)
+                self.bytes += size
+            self._evict()
+        return result
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self._entries:
+            _, (_, _, size) = self._entries.popitem(last=False)
+            self.bytes -= size
+
+    def set_max_bytes(self, max_bytes):
+        '''
+        Set the memory budget, dropping results over it.
+        '''
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        '''
+        Drop all cached results.
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        '''
+        :return stats: dict of hits, misses, entries, bytes and max_bytes
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+                    'bytes': self.bytes, 'max_bytes': self.max_bytes}
+
+
+# Shared by the tools that opt in with MyLibrary(cache=parse_cache), so
+# they reuse each other's parses
+parse_cache = ParseCache()
+
+
+# KeyValueTable values for '_' and for values kept as strings
+MISSING = 0xFFFFFFFF
+_STRING = 0xFFFFFFFE
+
+
+def _number(text, limit):
+    '''
+    The integer of a digit string that converts back to the same
+    string and is below limit, None otherwise.
+    '''
+    if not text.isascii() or not text.isdigit() or len(text) > 10 \
+            or (text[0] == '0' and len(text) > 1):
+        return None
+    number = int(text)
+    return number if number < limit else None
+
+
+# Sidecar file of a KeyValueTable, written next to the dump:
+# header, sorted keys, values, then the string keys and values as JSON
+SIDECAR_SUFFIX = '.kvt'
+SIDECAR_MAGIC = b'EKVT'
+SIDECAR_VERSION = 1
+_SIDECAR_HEADER = struct.Struct('<4sHHQq16sQQQ')
+
+# Sidecar file of a KeyOffsetIndex: header, sorted key hashes, offsets
+INDEX_SUFFIX = '.kvi'
+INDEX_MAGIC = b'EKVI'
+INDEX_VERSION = 1
+_INDEX_HEADER = struct.Struct('<4sHHQq16sQ')
+
+# Start of every sidecar header: magic, version, reserved and the size,
+# modification time and hash of the dump
+_SIDECAR_PREFIX = struct.Struct('<4sHHQq16s')
+
+
+def _file_hash(path):
+    '''
+    16 byte BLAKE2b digest of a file.
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def _sidecar_prefix(txt_file, magic, version):
+    '''
+    Header start of a new sidecar of txt_file.
+    '''
+    stat = os.stat(txt_file)
+    return _SIDECAR_PREFIX.pack(magic, version, 0, stat.st_size, stat.st_mtime_ns, _file_hash(txt_file))
+
+
+def _map_sidecar(txt_file, sidecar, header, magic, version):
+    '''
+    Memory map a sidecar of txt_file. A sidecar is stale when the size
+    of txt_file changed, or its modification time changed and so did
+    its content.
+
+    :return fields, mapped: unpacked header and mmap, None if missing,
+                            stale or broken
+    '''
+    try:
+        stat = os.stat(txt_file)
+        with open(sidecar, 'rb') as file:
+            data = file.read(header.size)
+            if len(data) < header.size:
+                return None
+            fields = header.unpack(data)
+            _, _, _, size, mtime_ns, source_hash = fields[:6]
+            if fields[0] != magic or fields[1] != version or size != stat.st_size:
+                return None
+
+            if mtime_ns != stat.st_mtime_ns:
+                if _file_hash(txt_file) != source_hash:
+                    return None
+                # Same content, remember the new time
+                with open(sidecar, 'r+b') as update:
+                    update.write(_SIDECAR_PREFIX.pack(magic, version, 0, size,
+                                                      stat.st_mtime_ns, source_hash))
+
+            return fields, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def _write_sidecar(sidecar, parts):
+    temp_file = sidecar + '.tmp'
+    try:
+        with open(temp_file, 'wb') as file:
+            for part in parts:
+                file.write(part)
+        os.replace(temp_file, sidecar)
+    except OSError:
+        # Do not leave the temp file next to the dump
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    return sidecar
+
+
+def _release(mapped, views):
+    '''
+    Release the memoryviews of a mapped sidecar and close it.
+    '''
+    if mapped is None:
+        return
+    for view in views:
+        if isinstance(view, memoryview):
+            view.release()
+    mapped.close()
+
+
+def _little_endian(words):
+    '''
+    Bytes of an array or memoryview of words in little endian order.
+    '''
+    if sys.byteorder == 'big':
+        words = array(words.format if isinstance(words, memoryview) else words.typecode, words)
+        words.byteswap()
+    return words.tobytes()
+
+
+class KeyValueTable(Mapping):
+    '''
+    Compact read only key value table of a dump, used like the dict of
+    read_key_value_pairs().
+
+    Keys are kept sorted in an array('I') with the values in a parallel
+    array('I'), MISSING stands for '_'. Lookups are binary searches and
+    the strings are only created when asked for. Keys and values that
+    do not convert back to the same string, e.g. '007' or '', are kept
+    as strings.
+    '''
+    def __init__(self, pairs=()):
+        '''
+        - pairs are (key, value) digit strings, the last value of a key
+          is kept.
+        '''
+        keys = array('I')
+        values = array('I')
+        self._string_values = {}
+        self._string_keys = {}
+
+        for key, value in pairs:
+            number = _number(key, 1 << 32)
+            if number is None:
+                self._string_keys[key] = value
+                continue
+
+            if value == '_':
+                stored = MISSING
+            else:
+                stored = _number(value, _STRING)
+                if stored is None:
+                    stored = _STRING
+                    self._string_values[number] = value
+            keys.append(number)
+            values.append(stored)
+
+        # Dumps are usually sorted already
+        if any(keys[i] >= keys[i + 1] for i in range(len(keys) - 1)):
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            sorted_keys = array('I')
+            sorted_values = array('I')
+            for position, index in enumerate(order):
+                # Equal keys keep their order, the last one wins
+                if position + 1 < len(order) and keys[order[position + 1]] == keys[index]:
+                    continue
+                sorted_keys.append(keys[index])
+                sorted_values.append(values[index])
+            keys, values = sorted_keys, sorted_values
+
+        self.keys_array = keys
+        self.values_array = values
+        self._mapped = None
+
+    @classmethod
+    def _from_arrays(cls, keys, values, string_keys, string_values, mapped=None):
+        '''
+        Table on already sorted key and value arrays, e.g. memoryviews
+        of a mapped sidecar kept open by mapped.
+        '''
+        table = cls.__new__(cls)
+        table.keys_array = keys
+        table.values_array = values
+        table._string_keys = string_keys
+        table._string_values = string_values
+        table._mapped = mapped
+        return table
+
+    def close(self):
+        '''
+        Release the memory mapped sidecar, if the table was loaded from
+        one. The table can not be used afterwards.
+        '''
+        _release(self._mapped, (self.keys_array, self.values_array))
+        self._mapped = None
+
+    def _index(self, number):
+        index = bisect.bisect_left(self.keys_array, number)
+        if index < len(self.keys_array) and self.keys_array[index] == number:
+            return index
+        return None
+
+    def _value(self, index):
+        value = self.values_array[index]
+        if value == MISSING:
+            return '_'
+        if value == _STRING:
+            return self._string_values[self.keys_array[index]]
+        return str(value)
+
+    def __getitem__(self, key):
+        number = _number(key, 1 << 32)
+        if number is None:
+            return self._string_keys[key]
+
+        index = self._index(number)
+        if index is None:
+            raise KeyError(key)
+        return self._value(index)
+
+    def __contains__(self, key):
+        number = _number(key, 1 << 32)
+        if number is None:
+            return key in self._string_keys
+        return self._index(number) is not None
+
+    def __iter__(self):
+        for number in self.keys_array:
+            yield str(number)
+        yield from self._string_keys
+
+    def __len__(self):
+        return len(self.keys_array) + len(self._string_keys)
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self.keys_array) \
+            + sys.getsizeof(self.values_array) + _size_of(self._string_keys) \
+            + _size_of(self._string_values)
+
+    def formatted(self, keys=None):
+        '''
+        Format pairs for display, all of them or the given keys that are
+        in the table.
+
+        :return lines: generator of 'key : value' strings
+        '''
+        if keys is None:
+            keys = self
+        for key in keys:
+            if key in self:
+                yield f'{key} : {self[key]}'
+
+    def to_numpy(self):
+        '''
+        The keys and values as NumPy arrays sharing the memory of the
+        table, MISSING stands for '_'. Values kept as strings are
+        not included.
+
+        :return keys, values: numpy uint32 arrays
+        '''
+        if numpy is None:
+            raise ImportError('NumPy is not installed.')
+        return (numpy.frombuffer(self.keys_array, dtype=numpy.uint32),
+                numpy.frombuffer(self.values_array, dtype=numpy.uint32))
+
+
+class KeyOffsetIndex:
+    '''
+    Index of the lines of a memory mapped dump by key, see
+    MyLibrary.read_key_index().
+
+    Holds the CRC-32 of every key, sorted, with the byte offset of its
+    line. A lookup parses only the lines with the same hash and keeps
+    the last one with the same key, as read_key_value_pairs() does.
+
+    The dump is only mapped while a batch of keys is looked up, so the
+    index does not keep it open and it can be edited or replaced.
+    '''
+    def __init__(self, txt_file, hashes, offsets, library, mapped=None):
+        self.txt_file = txt_file
+        self.hashes = hashes
+        self.offsets = offsets
+        self._library = library
+        self._mapped = mapped
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sys.getsizeof(self.hashes) + sys.getsizeof(self.offsets)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def close(self):
+        '''
+        Release the memory mapped sidecar, if the index was loaded from
+        one. The index can not be used afterwards.
+        '''
+        _release(self._mapped, (self.hashes, self.offsets))
+        self._mapped = None
+
+    def _map_text(self):
+        with open(self.txt_file, 'rb') as file:
+            if not os.fstat(file.fileno()).st_size:
+                return b''
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _line(self, text, offset):
+        end = text.find(b'\n', offset)
+        if end < 0:
+            end = len(text)
+        return text[offset:end].decode('utf-8')
+
+    def _find(self, text, key):
+        key_hash = zlib.crc32(key.encode('utf-8'))
+        hashes = self.hashes
+        index = bisect.bisect_left(hashes, key_hash)
+
+        value = None
+        split = self._library.strip_symbol_and_check_empty_space
+        while index < len(hashes) and hashes[index] == key_hash:
+            line_key, line_value = split(self._line(text, self.offsets[index]))
+            if line_key == key:
+                value = line_value
+            index += 1
+        return value
+
+    def get(self, key, default=None):
+        '''
+        Get the value of key.
+
+        :return value: value string, default if the key is not found
+        '''
+        return self.lookup((key,)).get(key, default)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def lookup(self, keys):
+        '''
+        Get the values of the given keys.
+
+        :return key_value_pairs: dict of the keys found to their values
+        '''
+        text = self._map_text()
+        try:
+            pairs = {}
+            for key in keys:
+                value = self._find(text, key)
+                if value is not None:
+                    pairs[key] = value
+            return pairs
+        finally:
+            if isinstance(text, mmap.mmap):
+                text.close()
+
+    def formatted(self, keys):
+        '''
+        Format the given keys that are in the file for display.
+
+        :return lines: generator of 'key : value' strings
+        '''
+        keys = list(keys)
+        pairs = self.lookup(keys)
+        for key in keys:
+            if key in pairs:
+                yield f'{key} : {pairs[key]}'
+
+
 class MyLibrary:
     '''Library for my tool'''
-    def __init__(self):
-        pass
+    def __init__(self, cache=None, sidecar=False):
+        '''
+        - cache is a ParseCache, e.g. parse_cache, to reuse the results of
+          the read methods. They are then shared with every other user of
+          the cache and must not be modified. None always parses.
+        - sidecar makes read_key_value_table() keep a binary sidecar next
+          to every dump and load that instead of parsing, see
+          write_sidecar().
+        '''
+        self.cache = cache
+        self.sidecar = sidecar
+
+    def _cached(self, kind, txt_file, parse):
+        if self.cache is None:
+            return parse(txt_file)
+        return self.cache.get(kind, txt_file, parse)
+
+    def digits(self, text):
+        '''
+        Keep only the digits of text.
+
+        :return digits: text without any other characters
+        '''
+        if text.isdigit():
+            return text
+        return _NON_DIGITS.sub('', text)
 
     def strip_symbol_and_check_empty_space(self, line):
         '''
@@ -15,17 +556,36 @@ class MyLibrary:
 
         :return key, value: replaced symbols and space values.
         '''
-        if len(line.split()) <= 2:
-            parts = line.split(':')
-            key = ''.join(filter(str.isdigit, parts[0].strip())) if parts[0].strip() else '_'
-            value = ''.join(filter(str.isdigit, parts[1].strip())) if parts[1].strip() else '_'
-            return key, value
-        else:
-            key, value = line.strip().split(None, 1)
-            key = ''.join(filter(str.isdigit, key))
-            value = ''.join(filter(str.isdigit, value))
-            return key, value
+        parts = line.split()
+        if len(parts) <= 2:
+            key, _, value = line.partition(':')
+            key = key.strip()
+            value = value.partition(':')[0].strip()
+            return (self.digits(key) if key else '_',
+                    self.digits(value) if value else '_')
+
+        # "key : value" or "key value ...", the value is all the rest
+        rest = parts[2:] if parts[1] == ':' else parts[1:]
+        return self.digits(parts[0]), self.digits(''.join(rest))
+
+    def iter_lines(self, txt_file):
+        '''
+        read a file line by line, skipping empty and comment lines.
+
+        :return lines: generator of stripped lines
+        '''
+        with open(txt_file, 'r', encoding='utf-8') as text_file:
+            # ignore empty space and comment lines
+            yield from (line for line in map(str.strip, text_file)
+                        if line and line[0] != '#')
+
+    def iter_key_value_pairs(self, txt_file):
+        '''
+        read a file line by line to get key value pairs.
 
+        :return pairs: iterator of (key, value) tuples
+        '''
+        return map(self.strip_symbol_and_check_empty_space, self.iter_lines(txt_file))
 
     def read_key_value_pairs(self, txt_file):
         '''
@@ -33,17 +593,148 @@ class MyLibrary:
 
         :return key_value_pairs: list of keys value pairs
         '''
-        key_value_pairs = {}
+        return self._cached('key_value_pairs', txt_file,
+                            lambda path: dict(self.iter_key_value_pairs(path)))
 
-        with open(txt_file, 'r', encoding='utf-8') as file:
-            lines = file.read().strip().split('\n')
-            for line in lines:
-                # ignore empty line space and comment lines
-                if line.strip() and not line.strip().startswith('#'):
-                    key, value = self.strip_symbol_and_check_empty_space(line)
-                    key_value_pairs[key] = value
-        return key_value_pairs
+    def read_key_value_table(self, txt_file):
+        '''
+        read a file to get a compact key value table, uses far less
+        memory than read_key_value_pairs() for big dumps. With sidecar
+        the table is memory mapped from the sidecar when up to date.
+
+        :return table: KeyValueTable
+        '''
+        return self._cached('key_value_table', txt_file, self._parse_table)
+
+    def write_sidecar(self, txt_file, table):
+        '''
+        Write table, parsed from txt_file, to the binary sidecar
+        txt_file + SIDECAR_SUFFIX.
+
+        :return sidecar: path of the sidecar file
+        '''
+        prefix = _sidecar_prefix(txt_file, SIDECAR_MAGIC, SIDECAR_VERSION)
+        strings = json.dumps({
+            'keys': table._string_keys,
+            'values': {str(key): value for key, value in table._string_values.items()},
+        }).encode('utf-8')
+
+        count = len(table.keys_array)
+        header = prefix + struct.pack('<QQQ', count, _SIDECAR_HEADER.size + 8 * count, len(strings))
+        return _write_sidecar(txt_file + SIDECAR_SUFFIX, (
+            header, _little_endian(table.keys_array), _little_endian(table.values_array), strings))
+
+    def load_sidecar(self, txt_file):
+        '''
+        Memory map the binary sidecar of txt_file. A sidecar is stale when
+        the size of txt_file changed, or its modification time changed
+        and so did its content.
+
+        :return table: KeyValueTable, None if missing or stale
+        '''
+        sidecar = _map_sidecar(txt_file, txt_file + SIDECAR_SUFFIX, _SIDECAR_HEADER,
+                               SIDECAR_MAGIC, SIDECAR_VERSION)
+        if sidecar is None:
+            return None
+
+        fields, mapped = sidecar
+        count, strings_offset, strings_length = fields[6:]
+        if len(mapped) < strings_offset + strings_length:
+            return None
+
+        view = memoryview(mapped)
+        start = _SIDECAR_HEADER.size
+        keys = view[start:start + 4 * count].cast('I')
+        values = view[start + 4 * count:strings_offset].cast('I')
+        if sys.byteorder == 'big':
+            keys = array('I', keys)
+            keys.byteswap()
+            values = array('I', values)
+            values.byteswap()
+
+        strings = json.loads(bytes(view[strings_offset:strings_offset + strings_length]).decode('utf-8'))
+        string_values = {int(key): value for key, value in strings['values'].items()}
+        return KeyValueTable._from_arrays(keys, values, strings['keys'], string_values, mapped)
+
+    def _parse_table(self, txt_file):
+        if self.sidecar:
+            table = self.load_sidecar(txt_file)
+            if table is not None:
+                return table
+
+        table = KeyValueTable(self.iter_key_value_pairs(txt_file))
+        if self.sidecar:
+            try:
+                self.write_sidecar(txt_file, table)
+            except OSError:
+                # Read only folder, parse again next time
+                pass
+        return table
 
+    def read_key_index(self, txt_file):
+        '''
+        read a file to get a key to line index, for looking up a few
+        keys in a big dump without parsing all of it. With sidecar the
+        index is kept in txt_file + INDEX_SUFFIX.
+
+        :return index: KeyOffsetIndex
+        '''
+        return self._cached('key_index', txt_file, self._parse_key_index)
+
+    def _parse_key_index(self, txt_file):
+        if self.sidecar:
+            sidecar = _map_sidecar(txt_file, txt_file + INDEX_SUFFIX, _INDEX_HEADER,
+                                   INDEX_MAGIC, INDEX_VERSION)
+            if sidecar is not None:
+                fields, mapped = sidecar
+                count = fields[6]
+                view = memoryview(mapped)
+                start = _INDEX_HEADER.size
+                if len(mapped) >= start + 12 * count:
+                    hashes = view[start:start + 4 * count].cast('I')
+                    offsets = view[start + 4 * count:start + 12 * count].cast('Q')
+                    if sys.byteorder == 'big':
+                        hashes = array('I', hashes)
+                        hashes.byteswap()
+                        offsets = array('Q', offsets)
+                        offsets.byteswap()
+                    return KeyOffsetIndex(txt_file, hashes, offsets, self, mapped)
+
+        hashes = array('I')
+        offsets = array('Q')
+        split = self.strip_symbol_and_check_empty_space
+        offset = 0
+        with open(txt_file, 'rb') as file:
+            for raw in file:
+                line = raw.decode('utf-8').strip()
+                # ignore empty space and comment lines
+                if line and line[0] != '#':
+                    hashes.append(zlib.crc32(split(line)[0].encode('utf-8')))
+                    offsets.append(offset)
+                offset += len(raw)
+
+        # Sorted by hash, lines of one hash stay in file order
+        order = sorted(range(len(hashes)), key=hashes.__getitem__)
+        hashes = array('I', [hashes[i] for i in order])
+        offsets = array('Q', [offsets[i] for i in order])
+
+        if self.sidecar:
+            header = _sidecar_prefix(txt_file, INDEX_MAGIC, INDEX_VERSION) + struct.pack('<Q', len(hashes))
+            try:
+                _write_sidecar(txt_file + INDEX_SUFFIX,
+                               (header, _little_endian(hashes), _little_endian(offsets)))
+            except OSError:
+                # Read only folder, index again next time
+                pass
+        return KeyOffsetIndex(txt_file, hashes, offsets, self)
+
+    def read_values(self, txt_file, keys):
+        '''
+        read only the given keys from a file, see read_key_index().
+
+        :return key_value_pairs: dict of the keys found to their values
+        '''
+        return self.read_key_index(txt_file).lookup(keys)
 
     def read_keys(self, key_txt_file):
         '''
@@ -51,16 +742,14 @@ class MyLibrary:
 
         :return keys, key_value_pair: list of keys and key value pair list
         '''
+        return self._cached('keys', key_txt_file, self._parse_keys)
+
+    def _parse_keys(self, key_txt_file):
         keys = []
         key_value_pair = []
-        with open(key_txt_file, 'r', encoding='utf-8') as text_file:
-            lines = text_file.read().strip().split('\n')
-            for line in lines:
-                # ignore empty space and comment lines
-                if line.strip() and not line.strip().startswith('#'):
-                    key, value = self.strip_symbol_and_check_empty_space(line)
-                    keys.append(key)
-                    key_value_pair.append(f'{key} : {value}')
+        for key, value in self.iter_key_value_pairs(key_txt_file):
+            keys.append(key)
+            key_value_pair.append(f'{key} : {value}')
 
         return keys, key_value_pair
 
@@ -70,15 +759,7 @@ class MyLibrary:
 
         :return _integer: list of integers
         '''
-        _integer = []
-        with open(txt_file, 'r', encoding='utf-8') as text_file:
-            lines = text_file.read().strip().split('\n')
-            for line in lines:
-                # ignore empty space and comment lines
-                if line.strip() and not line.strip().startswith('#'):
-                    _integer.append(line.strip())
-
-        return _integer
+        return self._cached('integer', txt_file, lambda path: list(self.iter_lines(path)))
     
     def read_links(self):
         '''
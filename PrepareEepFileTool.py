@@ -7,7 +7,7 @@ from prettytable import PrettyTable
 import MyLibrary
 
 # Create object
-MyLibrary = MyLibrary.MyLibrary()
+MyLibrary = MyLibrary.MyLibrary(cache=MyLibrary.parse_cache)
 table = PrettyTable()
 
 
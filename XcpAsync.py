@@ -0,0 +1,304 @@
+'''
+asyncio counterpart of pyxcp for driving many UPS serial ports from one
+event loop.
+
+Uses the same framing, checksum and response codes as pyxcp. Every port
+has its own pacing, so a slow unit does not hold up the others:
+
+    async def backup(ports):
+        clients = [AsyncXcp(port, 115200) for port in ports]
+        for client in clients:
+            await client.open()
+        return await asyncio.gather(*[
+            client.read_mem(2, AsyncXcp.MTYPE['EEPROM'], 0, 4096) for client in clients])
+
+Uses pyserial-asyncio when it is installed, otherwise the ports are
+polled without blocking the loop.
+'''
+import asyncio
+
+import serial
+
+from pyXCP import pyxcp, _xcpFrameParser
+
+try:
+    import serial_asyncio
+except ImportError:
+    serial_asyncio = None
+
+
+class AsyncXcp:
+    '''
+    One XCP connection, all requests are awaitable.
+    '''
+    CPUID = pyxcp.CPUID
+    MTYPE = pyxcp.MTYPE
+    MAXWORDS = pyxcp.MAXWORDS
+
+    # Shared protocol helpers, none of them touch the serial port
+    _response = pyxcp._response
+    _operationSuccessful = pyxcp._operationSuccessful
+    _combineBytesToWords = pyxcp._combineBytesToWords
+    _bytesToWordArray = pyxcp._bytesToWordArray
+    _getSecurityKey = pyxcp._getSecurityKey
+    _unlockAnswer = pyxcp._unlockAnswer
+    _keyProvider = None
+
+    def __init__(self, port, baud, tx_byte_wait=0.0, xcp_wait=0.1, max_words=64,
+                 poll_interval=0.001, **kwargs):
+        '''
+        - tx_byte_wait, xcp_wait and max_words as in pyxcp.
+        - poll_interval is how often the port is checked for received
+          bytes when pyserial-asyncio is not installed.
+        - kwargs are passed to the serial port.
+        '''
+        self.port = port
+        self.baud = baud
+        self.tx_byte_wait = tx_byte_wait
+        self.xcp_wait = xcp_wait
+        self.max_words = max_words
+        self.poll_interval = poll_interval
+        self._serial_kwargs = kwargs
+
+        self._reader = None
+        self._writer = None
+        self._serial = None
+        self._parser = _xcpFrameParser(pyxcp._XCP_SFD)
+
+        # One request/response at a time on a port
+        self._lock = asyncio.Lock()
+        self._last_write = 0.0
+        self._lastFailure = 'No failures has occured'
+
+    async def open(self):
+        '''
+        Opens the serial port.
+        '''
+        if serial_asyncio is not None:
+            self._reader, self._writer = await serial_asyncio.open_serial_connection(
+                url=self.port, baudrate=self.baud, **self._serial_kwargs)
+        else:
+            self._serial = serial.Serial(port=self.port, baudrate=self.baud, timeout=0,
+                                         **self._serial_kwargs)
+
+    async def close(self):
+        '''
+        Closes the serial port.
+        '''
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._reader = None
+        if self._serial is not None:
+            self._serial.close()
+            self._serial = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def get_failure_reason(self):
+        '''
+        Returns a human readable reason for the last failure.
+        '''
+        return self._lastFailure
+
+    def set_security_key_provider(self, provider):
+        '''
+        Sets the unlock key function, see pyxcp.setSecurityKeyProvider().
+        '''
+        self._keyProvider = provider
+
+    def _encode(self, payload):
+        '''
+        Encapsulates payload in XCP headers.
+        '''
+        if len(payload) > pyxcp._XCP_MAX_PAYLOAD:
+            raise ValueError(f'Maximum payload is {pyxcp._XCP_MAX_PAYLOAD} bytes.')
+
+        packet = bytearray(pyxcp._XCP_HEADER.pack(pyxcp._XCP_SFD, len(payload)))
+        packet += bytes(payload)
+        packet.append(pyxcp._CHECKSUM[sum(packet) & 0xFF])
+        return packet
+
+    async def _send(self, data):
+        if self._writer is not None:
+            self._writer.write(data)
+            await self._writer.drain()
+        else:
+            self._serial.write(data)
+
+    async def write(self, payload):
+        '''
+        Writes one packet, waiting xcp_wait since the previous one first.
+        '''
+        if len(payload) < 1:
+            return
+
+        packet = self._encode(payload)
+
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(max(0.0, self._last_write + self.xcp_wait - loop.time()))
+
+        if self.tx_byte_wait == 0:
+            await self._send(packet)
+        else:
+            for i in range(len(packet)):
+                await self._send(packet[i:i + 1])
+                await asyncio.sleep(self.tx_byte_wait)
+
+        self._last_write = loop.time()
+
+    async def _receive(self, timeout):
+        '''
+        Feeds received bytes to the parser, waits at most timeout.
+        '''
+        if self._reader is not None:
+            try:
+                data = await asyncio.wait_for(self._reader.read(4096), max(0.0, timeout))
+            except asyncio.TimeoutError:
+                return
+            self._parser.feed(data)
+            return
+
+        waiting = self._serial.in_waiting
+        if waiting:
+            self._parser.feed(self._serial.read(waiting))
+        else:
+            await asyncio.sleep(min(self.poll_interval, max(0.0, timeout)))
+
+    async def _next_sequence(self, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            seq = self._parser.nextSequence()
+            if seq:
+                return seq
+            if seq is False:
+                self._lastFailure = 'Checksum Error'
+                return None
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                self._lastFailure = 'Timeout'
+                return None
+            await self._receive(remaining)
+
+    async def read(self, timeout=2):
+        '''
+        Reads a whole response as pyxcp.read() does.
+
+        :return data: list of payload bytes, None on failure
+        '''
+        rec_data = bytearray()
+        first = True
+        while True:
+            seq = await self._next_sequence(timeout)
+            if seq is None:
+                return None
+
+            _, _, seq_num, payload = seq
+
+            # Check for ok response in first packet.
+            if first:
+                func_code = payload[0] if payload else None
+                if not self._operationSuccessful(func_code):
+                    self._lastFailure = self._response(func_code)
+                    return None
+                first = False
+
+            rec_data += payload
+
+            # Last sequence has the highest bit set
+            if seq_num & 0x80:
+                return list(rec_data)
+
+    async def _request(self, payload, timeout):
+        async with self._lock:
+            await self.write(payload)
+            return await self.read(timeout)
+
+    async def request_id_block(self, timeout=2):
+        '''
+        Requests the ID block. You have to parse it yourself.
+
+        :return data: list of payload bytes, None on failure
+        '''
+        XCP_REQID = 0x31
+        return await self._request([XCP_REQID], timeout)
+
+    async def read_mem(self, cpu_id, mem_type, start, length, timeout=2):
+        '''
+        Reads 'length' words starting from 'start', split into requests
+        of at most max_words words.
+
+        :return words: list of words, None on failure
+        '''
+        C9_READ = 0x52
+        words = []
+        done = 0
+        while done < length:
+            count = min(self.max_words, length - done)
+            request = pyxcp._C9_READ_REQUEST.pack(
+                pyxcp._C9_CMD, C9_READ, cpu_id & 0xFF, mem_type & 0xFF,
+                ((start + done) * 2) & 0xFFFFFFFF, (count * 2) & 0xFFFFFFFF)
+
+            data = await self._request(request, timeout)
+            if data is None:
+                return None
+
+            chunk = self._combineBytesToWords(data[pyxcp._C9_READ_RESPONSE_HEADER:])
+            if len(chunk) != count:
+                self._lastFailure = f'Received incorrect amount of words ({len(chunk)} of {count})'
+                return None
+
+            words += chunk
+            done += count
+        return words
+
+    async def write_mem(self, cpu_id, mem_type, adr, data, timeout=2):
+        '''
+        Writes the words in data to adr in order, split into requests of
+        at most max_words words.
+
+        :return success: True on success, False on failure
+        '''
+        C9_WRITE = 0x57
+        done = 0
+        while done < len(data):
+            # A write must fit in one packet
+            count = min(self.max_words, len(pyxcp._WORD_STRUCTS) - 1, len(data) - done)
+            header = pyxcp._C9_MEM_HEADER.pack(
+                pyxcp._C9_CMD, C9_WRITE, cpu_id & 0xFF, mem_type & 0xFF,
+                ((adr + done) * 2) & 0xFFFFFFFF)
+            words = pyxcp._WORD_STRUCTS[count].pack(
+                *[int(word) & 0xFFFF for word in data[done:done + count]])
+
+            if await self._request(header + words, timeout) is None:
+                return False
+            done += count
+        return True
+
+    async def unlock(self, timeout=1):
+        '''
+        Tries to unlock the XCP protocol, as pyxcp.unlock().
+
+        :return success: True on success, False otherwise
+        '''
+        async with self._lock:
+            await self.write([0xcf, 0x00, 0x00, 0x00])
+            data = await self.read(timeout)
+            if data is None:
+                return False
+
+            c9op = self._unlockAnswer(data)
+            if c9op is None:
+                return False
+
+            await self.write(c9op)
+            response = await self.read(timeout)
+
+        return response is not None and self._response(response[0]) == 'Accepted'
@@ -0,0 +1,133 @@
+'''
+Throughput benchmark of pyxcp against the XcpSimulator, so receive and
+pacing changes can be measured without hardware:
+
+    python XcpBenchmark.py
+
+Every benchmark moves the same amount of words and reports words and
+packets per second and the CPU time used. With the default zero latency
+simulator the numbers show the Python overhead per packet, give latency
+and byte_time to see how much of a real link is left idle.
+'''
+import time
+
+from pyXCP import pyxcp
+from XcpSimulator import XcpSimulator, simulator_key
+
+BENCHMARKS = ('readMem', 'writeMem', 'readMemRange', 'writeMemRange')
+
+CPU_ID = 2
+MEM_TYPE = pyxcp.MTYPE['EEPROM']
+
+
+class XcpBenchmark:
+    '''
+    Runs pyxcp memory transfers against a simulator.
+    '''
+    def __init__(self, words=8192, max_words=64, repeat=3, baud=115200, xcp_wait=0.0,
+                 latency=0.0, byte_time=0.0, receiver=False):
+        '''
+        - words is the amount of words moved by every benchmark.
+        - max_words is the request size, see pyxcp.MAXWORDS.
+        - repeat runs every benchmark this many times, the fastest run is
+          reported.
+        - xcp_wait is the pacing between packets, see pyxcp.
+        - latency and byte_time are passed to the simulator.
+        - receiver runs pyxcp with its receiver thread.
+        '''
+        self.words = words
+        self.max_words = max_words
+        self.repeat = repeat
+        self.receiver = receiver
+
+        self.sim = XcpSimulator(max_words=max_words, latency=latency, byte_time=byte_time,
+                                memory_words=max(words, 0x10000))
+        self.sim.load(CPU_ID, MEM_TYPE, 0, [i & 0xFFFF for i in range(words)])
+        self._data = [(i * 7) & 0xFFFF for i in range(words)]
+
+        self.xcp = pyxcp(None, baud, xcpWait=xcp_wait, maxWords=max_words)
+        self.xcp.setTransport(self.sim)
+        self.xcp.setSecurityKeyProvider(simulator_key)
+
+    def _read_mem(self):
+        for adr in range(0, self.words, self.max_words):
+            if self.xcp.readMem(CPU_ID, MEM_TYPE, adr, min(self.max_words, self.words - adr)) is None:
+                return False
+        return True
+
+    def _write_mem(self):
+        for adr in range(0, self.words, self.max_words):
+            if not self.xcp.writeMem(CPU_ID, MEM_TYPE, adr, self._data[adr:adr + self.max_words]):
+                return False
+        return True
+
+    def _read_mem_range(self):
+        return self.xcp.readMemRange(CPU_ID, MEM_TYPE, 0, self.words) is not None
+
+    def _write_mem_range(self):
+        return self.xcp.writeMemRange(CPU_ID, MEM_TYPE, 0, self._data)
+
+    def measure(self, name):
+        '''
+        Runs one benchmark, see BENCHMARKS.
+
+        :return result: dict with name, ok, words, packets, seconds,
+                        cpu_seconds, words_per_second and packets_per_second
+        '''
+        operation = {
+            'readMem': self._read_mem,
+            'writeMem': self._write_mem,
+            'readMemRange': self._read_mem_range,
+            'writeMemRange': self._write_mem_range,
+        }[name]
+
+        best = None
+        for _ in range(self.repeat):
+            packets = self.sim.stats['requests']
+            cpu_start = time.process_time()
+            start = time.perf_counter()
+            ok = operation()
+            seconds = time.perf_counter() - start
+            cpu_seconds = time.process_time() - cpu_start
+            packets = self.sim.stats['requests'] - packets
+
+            if not ok:
+                return {'name': name, 'ok': False, 'error': self.xcp.getFailureReason()}
+            if best is None or seconds < best['seconds']:
+                best = {'name': name, 'ok': True, 'words': self.words, 'packets': packets,
+                        'seconds': seconds, 'cpu_seconds': cpu_seconds,
+                        'words_per_second': self.words / seconds if seconds > 0 else 0.0,
+                        'packets_per_second': packets / seconds if seconds > 0 else 0.0}
+        return best
+
+    def run(self, names=BENCHMARKS):
+        '''
+        Runs the given benchmarks.
+
+        :return results: list of measure() results
+        '''
+        if self.receiver:
+            self.xcp.startReceiver()
+        try:
+            return [self.measure(name) for name in names]
+        finally:
+            self.xcp.stopReceiver()
+
+
+def format_results(results):
+    '''
+    :return text: results as a table
+    '''
+    lines = [f'{"benchmark":<14}{"words/s":>12}{"packets/s":>12}{"seconds":>10}{"cpu s":>10}']
+    for result in results:
+        if not result['ok']:
+            lines.append(f'{result["name"]:<14}failed: {result["error"]}')
+            continue
+        lines.append(f'{result["name"]:<14}{result["words_per_second"]:>12.0f}'
+                     f'{result["packets_per_second"]:>12.1f}{result["seconds"]:>10.3f}'
+                     f'{result["cpu_seconds"]:>10.3f}')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    print(format_results(XcpBenchmark().run()))
@@ -0,0 +1,257 @@
+'''
+Link auto calibration for pyxcp.
+
+Probes a target with harmless reads, and optionally writes of words just
+read, and binary searches for the smallest reliable txByteWait and
+xcpWait and the largest accepted read request.
+Results are stored per port and cpu id and loaded on the next connection,
+so sessions do not have to run with guessed, conservative delays.
+'''
+import json
+import os
+import time
+
+DEFAULT_PROFILE_FILE = os.path.join(os.path.expanduser('~'), '.pyxcp_profiles.json')
+
+
+def _profile_key(port, cpu_id):
+    return f'{port}/{cpu_id}'
+
+
+def load_profiles(profile_file=DEFAULT_PROFILE_FILE):
+    '''
+    read all stored link profiles.
+
+    :return profiles: dict of profile key to profile
+    '''
+    if not os.path.exists(profile_file):
+        return {}
+    with open(profile_file, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def save_profile(port, cpu_id, profile, profile_file=DEFAULT_PROFILE_FILE):
+    '''
+    store the link profile of one port and cpu id.
+    '''
+    profiles = load_profiles(profile_file)
+    profiles[_profile_key(port, cpu_id)] = profile
+
+    # Replace the file in one go so a crash cannot leave half a file
+    tmp_file = profile_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as file:
+        json.dump(profiles, file, indent=2, sort_keys=True)
+    os.replace(tmp_file, profile_file)
+
+
+def apply_profile(xcp, profile):
+    '''
+    set the pacing and request sizes of a profile on a pyxcp connection.
+    '''
+    xcp.setTxByteWait(profile['txByteWait'])
+    xcp.setXCPWait(profile['xcpWait'])
+    xcp.setMaxReadWords(profile['maxReadWords'])
+    xcp.setMaxWriteWords(profile['maxWriteWords'])
+
+
+def load_profile(xcp, cpu_id, profile_file=DEFAULT_PROFILE_FILE):
+    '''
+    apply the stored profile for the port of xcp and cpu_id, if any.
+
+    :return profile: the applied profile, None if nothing was stored
+    '''
+    profile = load_profiles(profile_file).get(_profile_key(xcp.port, cpu_id))
+    if profile is not None:
+        apply_profile(xcp, profile)
+    return profile
+
+
+class XcpCalibration:
+    '''
+    Finds the fastest reliable link settings of one target.
+    '''
+    def __init__(self, xcp, cpu_id, mem_type, adr=0, trials=5, timeout=0.5,
+                 margin=1.25, max_probe_words=256, probe_writes=False):
+        '''
+        - xcp is an open pyxcp connection, its current settings are used
+          as the known good starting point.
+        - cpu_id, mem_type and adr select the memory that is read while
+          probing. Pick something that is safe to read.
+        - trials is how many requests in a row must succeed for a setting
+          to count as reliable.
+        - margin multiplies the found waits for some headroom.
+        - max_probe_words is the largest read request tried.
+        - probe_writes also searches the largest write request and
+          txByteWait by writing back words just read from adr. Off by
+          default, txByteWait then keeps its current setting.
+        '''
+        self.xcp = xcp
+        self.cpu_id = cpu_id
+        self.mem_type = mem_type
+        self.adr = adr
+        self.trials = trials
+        self.timeout = timeout
+        self.margin = margin
+        self.max_probe_words = max_probe_words
+        self.probe_writes = probe_writes
+
+    def _reliable(self, operation):
+        for _ in range(self.trials):
+            if not operation():
+                return False
+        return True
+
+    def _read_ok(self, length):
+        return self._reliable(lambda: self.xcp.readMem(
+            self.cpu_id, self.mem_type, self.adr, length, timeout=self.timeout) is not None)
+
+    def _write_ok(self, length):
+        words = self.xcp.readMem(self.cpu_id, self.mem_type, self.adr, length, timeout=self.timeout)
+        if words is None:
+            return False
+        return self._reliable(lambda: self.xcp.writeMem(
+            self.cpu_id, self.mem_type, self.adr, words, timeout=self.timeout))
+
+    def _longest_ok(self):
+        '''
+        Probes with the longest requests sent: reads of maxReadWords and,
+        with probe_writes, writes of maxWriteWords.
+        '''
+        settings = self.xcp.getLinkSettings()
+        if not self._read_ok(settings['maxReadWords']):
+            return False
+        return not self.probe_writes or \
+            self._write_ok(min(settings['maxWriteWords'], settings['maxReadWords']))
+
+    def _smallest(self, low, high, works, resolution):
+        '''
+        Binary searches the smallest value in [low, high] that works,
+        expects high to work.
+        '''
+        while high - low > resolution:
+            middle = (low + high) / 2
+            if works(middle):
+                high = middle
+            else:
+                low = middle
+        return high
+
+    def _largest(self, low, high, works):
+        '''
+        Binary searches the largest integer in [low, high] that works,
+        expects low to work.
+        '''
+        while low < high:
+            middle = (low + high + 1) // 2
+            if works(middle):
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def calibrate_tx_byte_wait(self, resolution=0.0005):
+        '''
+        Probes with write requests of maxWriteWords words, the longest
+        packets sent. Read requests are too short to show a too small
+        wait, so without probe_writes the current setting is kept.
+
+        :return wait: smallest reliable wait between sent bytes
+        '''
+        xcp = self.xcp
+        settings = xcp.getLinkSettings()
+        start = settings['txByteWait']
+        if not self.probe_writes:
+            return start
+
+        length = min(settings['maxWriteWords'], settings['maxReadWords'])
+
+        def works(wait):
+            xcp.setTxByteWait(wait)
+            return self._write_ok(length)
+
+        wait = 0.0 if works(0.0) else self._smallest(0.0, start, works, resolution)
+        xcp.setTxByteWait(wait)
+        return wait
+
+    def calibrate_xcp_wait(self, resolution=0.001):
+        '''
+        Probes with requests of the current maximum sizes, see
+        calibrate_max_words().
+
+        :return wait: smallest reliable wait between packets
+        '''
+        xcp = self.xcp
+        start = xcp.getLinkSettings()['xcpWait']
+
+        def works(wait):
+            xcp.setXCPWait(wait)
+            return self._longest_ok()
+
+        wait = 0.0 if works(0.0) else self._smallest(0.0, start, works, resolution)
+        xcp.setXCPWait(wait)
+        return wait
+
+    def calibrate_max_words(self):
+        '''
+        :return read_words, write_words: largest reliable request sizes.
+                                         write_words is the current
+                                         setting unless probe_writes.
+        '''
+        xcp = self.xcp
+        read_words = self._largest(1, self.max_probe_words, self._read_ok)
+        xcp.setMaxReadWords(read_words)
+
+        write_words = xcp.getLinkSettings()['maxWriteWords']
+        if self.probe_writes:
+            # Setter limits the probe to what fits in one packet
+            xcp.setMaxWriteWords(self.max_probe_words)
+            write_words = self._largest(1, xcp.getLinkSettings()['maxWriteWords'], self._write_ok)
+            xcp.setMaxWriteWords(write_words)
+        return read_words, write_words
+
+    def calibrate(self):
+        '''
+        Runs all searches and applies the result, with margin added to
+        the waits, to the connection.
+
+        :return profile: dict of the found settings, None if the link does
+                         not work even with the starting settings.
+        '''
+        xcp = self.xcp
+        start = xcp.getLinkSettings()
+
+        if not self._read_ok(1):
+            return None
+
+        # Request sizes are searched with the known good starting waits,
+        # then the waits with requests of the found sizes. txByteWait
+        # first with the starting xcpWait, then xcpWait with the found
+        # txByteWait
+        read_words, write_words = self.calibrate_max_words()
+        tx_byte_wait = self.calibrate_tx_byte_wait()
+        if self.probe_writes:
+            tx_byte_wait *= self.margin
+        xcp.setTxByteWait(tx_byte_wait)
+        xcp_wait = self.calibrate_xcp_wait()
+
+        profile = {
+            'txByteWait': tx_byte_wait,
+            'xcpWait': xcp_wait * self.margin,
+            'maxReadWords': read_words,
+            'maxWriteWords': write_words,
+            'calibrated': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'baseline': start,
+        }
+        apply_profile(xcp, profile)
+        return profile
+
+    def calibrate_and_save(self, profile_file=DEFAULT_PROFILE_FILE):
+        '''
+        Calibrates and stores the profile for the port and cpu id.
+
+        :return profile: as calibrate()
+        '''
+        profile = self.calibrate()
+        if profile is not None:
+            save_profile(self.xcp.port, self.cpu_id, profile, profile_file)
+        return profile
@@ -0,0 +1,270 @@
+'''
+Records the serial traffic of a pyxcp connection and replays it later
+without hardware.
+
+Recording wraps the connection's _writeSerial() and _readSerial(), so it
+works with a real port as well as any transport, and costs nothing once
+stopped:
+
+    with XcpCapture(xcp, 'dump.xcap'):
+        xcp.readMemRange(2, pyxcp.MTYPE['EEPROM'], 0, 4096)
+
+A replay answers the same requests with the recorded responses, at the
+original speed or as fast as possible:
+
+    xcp = replay('dump.xcap', speed=None, xcpWait=0)
+    words = xcp.readMemRange(2, pyxcp.MTYPE['EEPROM'], 0, 4096)
+
+The file is a header followed by one record per write or read: time in
+seconds since the start, direction and the bytes.
+'''
+import struct
+import threading
+import time
+from collections import deque
+
+from pyXCP import pyxcp
+
+CAPTURE_MAGIC = b'XCC1'
+CAPTURE_HEADER = struct.Struct('<4sId')
+CAPTURE_RECORD = struct.Struct('<dBH')
+
+TX = 0
+RX = 1
+
+
+class XcpCapture:
+    '''
+    Records the traffic of one pyxcp connection to a capture file.
+    '''
+    def __init__(self, xcp, capture_file, buffer_size=65536):
+        '''
+        - xcp is an open pyxcp connection.
+        - buffer_size is how many bytes are collected before they are
+          written to the file.
+        '''
+        self.xcp = xcp
+        self.capture_file = capture_file
+        self.buffer_size = buffer_size
+        self._file = None
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._start = 0.0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        '''
+        Starts recording, the capture file is overwritten.
+        '''
+        if self._file is not None:
+            return
+
+        self._file = open(self.capture_file, 'wb')
+        self._file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, int(self.xcp.baudrate or 0), time.time()))
+        self._start = time.perf_counter()
+
+        write_serial = self.xcp._writeSerial
+        read_serial = self.xcp._readSerial
+
+        def _writeSerial(data):
+            self._record(TX, data)
+            return write_serial(data)
+
+        def _readSerial():
+            data = read_serial()
+            if data:
+                self._record(RX, data)
+            return data
+
+        # Instance attributes shadow the methods until stop()
+        self.xcp._writeSerial = _writeSerial
+        self.xcp._readSerial = _readSerial
+
+    def stop(self):
+        '''
+        Stops recording and closes the capture file.
+        '''
+        if self._file is None:
+            return
+
+        del self.xcp._writeSerial
+        del self.xcp._readSerial
+
+        with self._lock:
+            self._file.write(self._buffer)
+            self._buffer.clear()
+            self._file.close()
+            self._file = None
+
+    def _record(self, direction, data):
+        stamp = time.perf_counter() - self._start
+        with self._lock:
+            buffer = self._buffer
+            # Records hold at most 65535 bytes
+            for i in range(0, len(data), 0xFFFF):
+                chunk = data[i:i + 0xFFFF]
+                buffer += CAPTURE_RECORD.pack(stamp, direction, len(chunk))
+                buffer += chunk
+            if len(buffer) >= self.buffer_size:
+                self._file.write(buffer)
+                buffer.clear()
+
+
+def read_capture(capture_file):
+    '''
+    read a capture file.
+
+    :return baud, start, records: baud rate, wall clock start time and a
+                                  list of (time, direction, bytes)
+    '''
+    with open(capture_file, 'rb') as file:
+        data = file.read()
+
+    magic, baud, start = CAPTURE_HEADER.unpack_from(data, 0)
+    if magic != CAPTURE_MAGIC:
+        raise ValueError(f'{capture_file} is not a capture file.')
+
+    records = []
+    position = CAPTURE_HEADER.size
+    while position + CAPTURE_RECORD.size <= len(data):
+        stamp, direction, length = CAPTURE_RECORD.unpack_from(data, position)
+        position += CAPTURE_RECORD.size
+        records.append((stamp, direction, data[position:position + length]))
+        position += length
+    return baud, start, records
+
+
+class XcpReplay:
+    '''
+    pyxcp transport that answers with the responses of a capture.
+
+    Every write is matched against the next recorded request, then the
+    responses recorded after it are received. Writes that differ from
+    the recording are counted in mismatches.
+    '''
+    def __init__(self, capture_file, speed=1.0, timeout=0.05):
+        '''
+        - speed scales the recorded response times, None receives the
+          responses right away.
+        - timeout is how long read() blocks when nothing is received.
+        '''
+        self.baud, _, records = read_capture(capture_file)
+        self.speed = speed
+        self.timeout = timeout
+
+        # Requests written in chunks are joined, responses keep their times
+        self._records = []
+        for stamp, direction, data in records:
+            if direction == TX and self._records and self._records[-1][1] == TX:
+                self._records[-1][2].extend(data)
+            else:
+                self._records.append([stamp, direction, bytearray(data)])
+
+        self._next = 0
+        self._tx = bytearray()
+        self._pending = deque()
+        self._condition = threading.Condition()
+        self.mismatches = []
+
+    def done(self):
+        '''
+        :return done: True when every recorded record has been replayed
+        '''
+        return self._next >= len(self._records) and not self._pending
+
+    def write(self, data):
+        with self._condition:
+            self._tx += data
+            self._match()
+            self._condition.notify_all()
+        return len(data)
+
+    def _match(self):
+        records = self._records
+        while self._tx:
+            # Responses recorded before any request are sent right away
+            if self._next < len(records) and records[self._next][1] == RX:
+                self._schedule(records[self._next][0])
+                continue
+            if self._next >= len(records):
+                self.mismatches.append((self._next, b'', bytes(self._tx)))
+                self._tx.clear()
+                return
+
+            stamp, _, expected = records[self._next]
+            if len(self._tx) < len(expected):
+                return
+
+            if self._tx[:len(expected)] != expected:
+                self.mismatches.append((self._next, bytes(expected), bytes(self._tx[:len(expected)])))
+            del self._tx[:len(expected)]
+            self._next += 1
+            self._schedule(stamp)
+
+    def _schedule(self, stamp):
+        '''
+        Queues the responses following the current record, relative to
+        the recorded time stamp.
+        '''
+        now = time.perf_counter()
+        records = self._records
+        while self._next < len(records) and records[self._next][1] == RX:
+            rx_stamp, _, data = records[self._next]
+            ready = now
+            if self.speed:
+                ready += max(0.0, rx_stamp - stamp) / self.speed
+            self._pending.append([ready, bytes(data), 0])
+            self._next += 1
+
+    @property
+    def in_waiting(self):
+        with self._condition:
+            now = time.perf_counter()
+            return sum(len(data) - done for ready, data, done in self._pending if ready <= now)
+
+    def read(self, size=1):
+        deadline = time.perf_counter() + (self.timeout or 0.0)
+        with self._condition:
+            while True:
+                now = time.perf_counter()
+                pending = self._pending
+                if pending and pending[0][0] <= now:
+                    out = bytearray()
+                    while pending and pending[0][0] <= now and len(out) < size:
+                        entry = pending[0]
+                        count = min(len(entry[1]) - entry[2], size - len(out))
+                        out += entry[1][entry[2]:entry[2] + count]
+                        entry[2] += count
+                        if entry[2] == len(entry[1]):
+                            pending.popleft()
+                    return bytes(out)
+
+                remaining = deadline - now
+                if remaining <= 0:
+                    return b''
+                if pending:
+                    remaining = min(remaining, pending[0][0] - now)
+                self._condition.wait(remaining)
+
+    def reset_input_buffer(self):
+        with self._condition:
+            self._pending.clear()
+
+
+def replay(capture_file, speed=1.0, **xcp_kwargs):
+    '''
+    Opens a pyxcp connection replaying a capture, see XcpReplay.
+    xcp_kwargs are passed to pyxcp, e.g. xcpWait=0 when speed is None.
+
+    :return xcp: pyxcp connection, its transport is the XcpReplay
+    '''
+    transport = XcpReplay(capture_file, speed)
+    xcp = pyxcp(None, transport.baud or 115200, **xcp_kwargs)
+    xcp.setTransport(transport)
+    return xcp
@@ -0,0 +1,120 @@
+'''
+Dumps the same memory ranges from many units in parallel, one serial
+port per unit.
+
+Every unit gets its own pyxcp connection in a thread (or process) pool,
+so the total time is that of the slowest unit instead of the sum of all.
+Words are streamed to one "address : value" file per unit as they
+arrive. The files can be opened directly in CompareFilesWithGivenKeys.
+'''
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import serial
+
+from pyXCP import pyxcp
+
+# One unit to dump. ranges is a list of (start, length) word ranges.
+FleetJob = namedtuple('FleetJob', ['port', 'baud', 'cpu_id', 'mem_type', 'ranges'])
+
+
+def _file_name(port):
+    '''
+    File name for a port, COM3 -> COM3.txt, /dev/ttyUSB0 -> dev_ttyUSB0.txt
+    '''
+    return port.strip('/\\').replace('/', '_').replace('\\', '_') + '.txt'
+
+
+def dump_unit(job, out_dir, unlock=False, xcp_kwargs=None):
+    '''
+    Dumps the ranges of one unit to out_dir. Runs in a pool worker.
+
+    :return result: dict with port, ok, words, seconds, file and error
+    '''
+    start_time = time.perf_counter()
+    out_file = os.path.join(out_dir, _file_name(job.port))
+    result = {'port': job.port, 'ok': False, 'words': 0, 'seconds': 0.0,
+              'file': out_file, 'error': None}
+
+    try:
+        xcp = pyxcp(job.port, job.baud, **(xcp_kwargs or {}))
+    except (serial.SerialException, ValueError) as error:
+        result['error'] = f'Could not open port: {error}'
+        return result
+
+    try:
+        with open(out_file, 'w', encoding='utf-8') as text_file:
+            def write_chunk(adr, words):
+                text_file.write(''.join(f'{a} : {w}\n' for a, w in enumerate(words, adr)))
+                result['words'] += len(words)
+
+            if unlock and not xcp.unlock():
+                result['error'] = f'Unlock failed: {xcp.getFailureReason()}'
+                return result
+
+            for start, length in job.ranges:
+                words = xcp.readMemRange(job.cpu_id, job.mem_type, start, length, onChunk=write_chunk)
+                if words is None:
+                    result['error'] = xcp.getFailureReason()
+                    return result
+
+        result['ok'] = True
+        return result
+    finally:
+        xcp.close()
+        result['seconds'] = time.perf_counter() - start_time
+
+
+class XcpFleet:
+    '''
+    Runs FleetJobs in parallel and reports aggregate throughput.
+    '''
+    def __init__(self, jobs, out_dir, workers=None, use_processes=False, unlock=False, **xcp_kwargs):
+        '''
+        - jobs is a list of FleetJob or (port, baud, cpu_id, mem_type, ranges).
+        - out_dir is where the unit files are written.
+        - workers defaults to one per job.
+        - use_processes runs the units in processes instead of threads.
+        - unlock unlocks every unit before reading.
+        - xcp_kwargs are passed to every pyxcp connection.
+        '''
+        self.jobs = [FleetJob(*job) for job in jobs]
+        self.out_dir = out_dir
+        self.workers = workers or max(1, len(self.jobs))
+        self.use_processes = use_processes
+        self.unlock = unlock
+        self.xcp_kwargs = xcp_kwargs
+
+    def run(self, progress=None):
+        '''
+        Dumps all units. progress is called as progress(result) when a
+        unit finishes.
+
+        :return summary: dict with per unit results, failures, total words,
+                         seconds and words_per_second
+        '''
+        os.makedirs(self.out_dir, exist_ok=True)
+        pool_class = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+
+        start_time = time.perf_counter()
+        results = []
+        with pool_class(max_workers=self.workers) as pool:
+            futures = [pool.submit(dump_unit, job, self.out_dir, self.unlock, self.xcp_kwargs)
+                       for job in self.jobs]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                if progress is not None:
+                    progress(result)
+        seconds = time.perf_counter() - start_time
+
+        words = sum(result['words'] for result in results)
+        return {
+            'units': sorted(results, key=lambda result: result['port']),
+            'failures': [result for result in results if not result['ok']],
+            'words': words,
+            'seconds': seconds,
+            'words_per_second': words / seconds if seconds > 0 else 0.0,
+        }
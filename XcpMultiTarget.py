@@ -0,0 +1,156 @@
+'''
+Reads the same memory ranges from several cpus behind one XCP link, e.g.
+a parameter block from every UPM of a 93PM.
+
+Requests for the targets are interleaved chunk by chunk, and decoding of
+a response is queued into the pacing wait before the next request, so
+the link never sits idle while Python decodes. Where the product has a
+broadcast cpu id covering the targets it is tried first, and targets that
+do not answer the broadcast are read one by one.
+'''
+from array import array
+
+from pyXCP import pyxcp
+
+
+def _broadcast_groups():
+    '''
+    Broadcast cpu id name -> member cpu id names, per product.
+    '''
+    upms = [f'UPM{i}' for i in range(1, 17)]
+    return {
+        '93PM': {
+            'AllUPMs': upms,
+            'AllUPMPLDs': [f'{upm}PLD' for upm in upms],
+            'AllUPMBootloaders': [f'{upm}Bootloader' for upm in upms],
+        },
+    }
+
+
+BROADCAST = _broadcast_groups()
+
+
+class XcpMultiTarget:
+    '''
+    Plans and runs reads of one set of ranges from many cpu ids.
+    '''
+    def __init__(self, xcp, product='93PM', use_broadcast=True, broadcast_timeout=0.5):
+        '''
+        - xcp is an open pyxcp connection.
+        - product selects the cpu id and broadcast tables, see pyxcp.CPUID.
+        - use_broadcast tries the broadcast ids for groups of targets.
+        - broadcast_timeout is how long to wait for each further answer
+          to a broadcast.
+        '''
+        self.xcp = xcp
+        self.product = product
+        self.use_broadcast = use_broadcast
+        self.broadcast_timeout = broadcast_timeout
+
+        cpu_ids = pyxcp.CPUID[product]
+        self._groups = {}
+        for name, members in BROADCAST.get(product, {}).items():
+            self._groups[cpu_ids[name]] = {cpu_ids[member] for member in members}
+
+        # Broadcast ids that got no answer at all are not tried again
+        self._unsupported = set()
+
+    def _chunks(self, ranges):
+        max_words = self.xcp.getLinkSettings()['maxReadWords']
+        for index, (start, length) in enumerate(ranges):
+            for offset in range(0, length, max_words):
+                yield index, offset, start + offset, min(max_words, length - offset)
+
+    def plan(self, cpu_ids):
+        '''
+        Splits the targets into broadcast groups and single targets.
+
+        :return broadcasts, singles: list of (broadcast id, member ids) and
+                                     list of cpu ids read one by one
+        '''
+        remaining = set(cpu_ids)
+        broadcasts = []
+        if self.use_broadcast:
+            for broadcast_id, members in self._groups.items():
+                wanted = remaining & members
+                if len(wanted) > 1 and broadcast_id not in self._unsupported:
+                    broadcasts.append((broadcast_id, wanted))
+                    remaining -= wanted
+        return broadcasts, sorted(remaining)
+
+    def _store(self, results, cpu_id, index, offset, data, length):
+        words = self.xcp._decodeMemResponse(data, length) if data else None
+        if words is not None and results[cpu_id][index] is not None:
+            results[cpu_id][index][offset:offset + length] = array('H', words)
+        else:
+            results[cpu_id][index] = None
+
+    def _read_broadcast(self, broadcast_id, members, mem_type, adr, length):
+        '''
+        Sends one broadcast read and collects the answers by cpu id.
+        '''
+        xcp = self.xcp
+        xcp._readFromMemRequest(broadcast_id, mem_type, adr, length)
+
+        answers = {}
+        timeout = None
+        while len(answers) < len(members):
+            data = xcp._readMemResponse(length, timeout)
+            if data is None:
+                break
+            # Late answers to earlier requests are skipped
+            if data[1] in members and xcp._checkMemResponse(data, None, adr, length):
+                answers[data[1]] = data
+            timeout = self.broadcast_timeout
+
+        if not answers:
+            self._unsupported.add(broadcast_id)
+            xcp.resync()
+        return answers
+
+    def read(self, cpu_ids, mem_type, ranges):
+        '''
+        Reads the (start, length) ranges from every cpu id.
+
+        :return results: dict of cpu id -> list with one array('H') per
+                         range, None for ranges that failed
+        '''
+        xcp = self.xcp
+        results = {cpu_id: [array('H', bytes(2 * length)) for _, length in ranges]
+                   for cpu_id in cpu_ids}
+        broadcasts, singles = self.plan(cpu_ids)
+
+        for index, offset, adr, length in self._chunks(ranges):
+            pending = list(singles)
+
+            for broadcast_id, members in broadcasts:
+                if broadcast_id in self._unsupported:
+                    pending += sorted(members)
+                    continue
+
+                answers = self._read_broadcast(broadcast_id, members, mem_type, adr, length)
+                for cpu_id, data in answers.items():
+                    xcp.runDuringWait(lambda c=cpu_id, d=data, i=index, o=offset, n=length:
+                                      self._store(results, c, i, o, d, n))
+                pending += sorted(members - set(answers))
+
+            for cpu_id in pending:
+                if results[cpu_id][index] is None:
+                    continue
+
+                xcp._readFromMemRequest(cpu_id, mem_type, adr, length)
+                data = xcp._readMemResponse(length)
+                if data is not None and not xcp._checkMemResponse(data, cpu_id, adr, length):
+                    data = None
+
+                # The rest of a failed or late response must not answer the next request
+                if data is None:
+                    xcp.resync()
+
+                # Decoded while the next request waits for the link
+                xcp.runDuringWait(lambda c=cpu_id, d=data, i=index, o=offset, n=length:
+                                  self._store(results, c, i, o, d, n))
+
+        # Decode what is still queued
+        xcp.runQueuedWork()
+        return results
@@ -0,0 +1,224 @@
+'''
+Cyclic variable poller over XCP, a scriptable replacement for the
+Panda VAR Logger.
+
+Every watched variable has its own rate. On each cycle the variables that
+are due are merged into as few readMem requests as possible, the merge is
+worked out once per set of due variables and reused. Samples go into a
+fixed size ring buffer of arrays and can be streamed to a compact binary
+log, nothing is allocated per sample.
+'''
+import struct
+import time
+from array import array
+
+from pyXCP import pyxcp
+
+# Binary log: header, then one entry per watched variable, then samples
+LOG_MAGIC = b'XPL1'
+LOG_HEADER = struct.Struct('<4sH')
+LOG_ENTRY = struct.Struct('<IBd')
+LOG_SAMPLE = struct.Struct('<dHI')
+
+
+class XcpPoller:
+    '''
+    Samples a watch list of (address, width, rate) variables.
+    '''
+    def __init__(self, xcp, cpu_id, watch_list, capacity=65536, max_gap=8,
+                 mem_type=pyxcp.MTYPE['variable'], log_file=None):
+        '''
+        - xcp is an open pyxcp connection.
+        - watch_list is a list of (address, width, rate): width in words
+          (1 or 2, two words are combined low word first) and rate in
+          samples per second.
+        - capacity is the amount of samples kept in the ring buffer.
+        - max_gap is the largest hole between two variables that is read
+          along to merge their requests.
+        - log_file, if given, receives every sample in binary form.
+        '''
+        self.xcp = xcp
+        self.cpu_id = cpu_id
+        self.mem_type = mem_type
+        self.max_gap = max_gap
+        self.entries = [(int(adr), int(width), float(rate)) for adr, width, rate in watch_list]
+        for adr, width, _ in self.entries:
+            if width not in (1, 2):
+                raise ValueError(f'Width of address {adr} must be 1 or 2 words.')
+        self._periods = [1.0 / rate for _, _, rate in self.entries]
+        self._next_due = array('d', [0.0] * len(self.entries))
+
+        # Ring buffer of samples
+        self.capacity = capacity
+        self._times = array('d', [0.0]) * capacity
+        self._ids = array('H', [0]) * capacity
+        self._values = array('I', [0]) * capacity
+        self._head = 0
+        self.count = 0
+
+        # Merged requests per set of due variables
+        self._plans = {}
+
+        self._log = None
+        self._log_buffer = bytearray(LOG_SAMPLE.size * max(1, len(self.entries)))
+        if log_file is not None:
+            self._open_log(log_file)
+
+    def _open_log(self, log_file):
+        self._log = open(log_file, 'wb')
+        self._log.write(LOG_HEADER.pack(LOG_MAGIC, len(self.entries)))
+        for adr, width, rate in self.entries:
+            self._log.write(LOG_ENTRY.pack(adr, width, rate))
+
+    def close(self):
+        '''
+        Closes the binary log.
+        '''
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def _plan(self, due):
+        '''
+        Merges the due variables into read requests.
+
+        :return requests: list of (start, length, [(id, offset, width)])
+        '''
+        plan = self._plans.get(due)
+        if plan is not None:
+            return plan
+
+        max_words = self.xcp.getLinkSettings()['maxReadWords']
+        plan = []
+        for index in sorted(due, key=lambda i: self.entries[i][0]):
+            adr, width, _ = self.entries[index]
+            if plan:
+                start, length, members = plan[-1]
+                end = max(start + length, adr + width)
+                if adr - (start + length) <= self.max_gap and end - start <= max_words:
+                    members.append((index, adr - start, width))
+                    plan[-1] = (start, end - start, members)
+                    continue
+            plan.append((adr, width, [(index, 0, width)]))
+
+        self._plans[due] = plan
+        return plan
+
+    def poll_once(self):
+        '''
+        Reads every variable that is due.
+
+        :return samples: amount of samples stored, None if a read failed
+        '''
+        now = time.perf_counter()
+        next_due = self._next_due
+        due = tuple(i for i in range(len(next_due)) if next_due[i] <= now)
+        if not due:
+            return 0
+
+        for i in due:
+            # Keep the phase, but when behind (and on the first cycle) do not
+            # try to catch up missed cycles
+            next_due[i] += self._periods[i]
+            if next_due[i] <= now:
+                next_due[i] = now + self._periods[i]
+
+        stamp = time.time()
+        stored = 0
+        for start, length, members in self._plan(due):
+            words = self.xcp.readMem(self.cpu_id, self.mem_type, start, length)
+            if words is None:
+                self._write_log(stored)
+                return None
+
+            for index, offset, width in members:
+                value = words[offset]
+                if width > 1:
+                    value |= words[offset + 1] << 16
+                self._store(stamp, index, value, stored)
+                stored += 1
+
+        self._write_log(stored)
+        return stored
+
+    def _write_log(self, stored):
+        if self._log is not None and stored:
+            self._log.write(memoryview(self._log_buffer)[:stored * LOG_SAMPLE.size])
+
+    def _store(self, stamp, index, value, position):
+        head = self._head
+        self._times[head] = stamp
+        self._ids[head] = index
+        self._values[head] = value
+        self._head = (head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+        if self._log is not None:
+            LOG_SAMPLE.pack_into(self._log_buffer, position * LOG_SAMPLE.size, stamp, index, value)
+
+    def run(self, duration=None, cycles=None, stop=None):
+        '''
+        Polls until duration seconds or cycles cycles have passed, or
+        stop (a threading.Event) is set.
+
+        :return success: False if a read failed
+        '''
+        end = None if duration is None else time.perf_counter() + duration
+        done = 0
+        while (cycles is None or done < cycles) and not (stop is not None and stop.is_set()):
+            if self.poll_once() is None:
+                return False
+            done += 1
+
+            wait = min(self._next_due) - time.perf_counter()
+            if end is not None:
+                if time.perf_counter() >= end:
+                    break
+                wait = min(wait, end - time.perf_counter())
+            if wait > 0:
+                time.sleep(wait)
+        return True
+
+    def samples(self):
+        '''
+        :return samples: stored samples oldest first as (time, id, value),
+                         id being the index in the watch list
+        '''
+        start = (self._head - self.count) % self.capacity
+        for i in range(self.count):
+            position = (start + i) % self.capacity
+            yield self._times[position], self._ids[position], self._values[position]
+
+    def latest(self):
+        '''
+        :return values: latest value of every watched variable, None if
+                        not sampled yet
+        '''
+        values = [None] * len(self.entries)
+        for _, index, value in self.samples():
+            values[index] = value
+        return values
+
+
+def read_log(log_file):
+    '''
+    read a binary log written by XcpPoller.
+
+    :return entries, samples: watch list and list of (time, id, value)
+    '''
+    with open(log_file, 'rb') as file:
+        data = file.read()
+
+    magic, count = LOG_HEADER.unpack_from(data, 0)
+    if magic != LOG_MAGIC:
+        raise ValueError(f'{log_file} is not a poller log.')
+
+    position = LOG_HEADER.size
+    entries = []
+    for _ in range(count):
+        entries.append(LOG_ENTRY.unpack_from(data, position))
+        position += LOG_ENTRY.size
+
+    end = position + (len(data) - position) // LOG_SAMPLE.size * LOG_SAMPLE.size
+    return entries, list(LOG_SAMPLE.iter_unpack(data[position:end]))
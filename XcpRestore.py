@@ -0,0 +1,182 @@
+'''
+Restores EEP files to a unit over XCP with as few packets as possible.
+
+Restore files are the "address : value" files made by PrepareEepFileTool.
+The pairs are sorted and merged into contiguous runs which are then sent
+with pyxcp.writeMemRange() in maximum size chunks.
+'''
+from MyLibrary import MyLibrary
+
+
+class RestorePlan:
+    '''
+    Result of XcpRestore.plan().
+
+    runs are (start, length) spans to write. values holds the words given
+    by the restore file, gap words come from cache or are read from the
+    unit with the (start, length) spans in gap_reads before writing.
+    '''
+    def __init__(self, runs, values, cache, gap_reads, packets):
+        self.runs = runs
+        self.values = values
+        self.cache = cache
+        self.gap_reads = gap_reads
+        self.packets = packets
+
+    def words(self):
+        '''
+        Amount of words written when the plan is sent.
+        '''
+        return sum(length for _, length in self.runs)
+
+
+class XcpRestore:
+    '''
+    Plans and sends restores of scattered "address : value" pairs.
+    '''
+    def __init__(self, max_words=64, max_read_words=64, max_gap=8):
+        '''
+        - max_words is the largest amount of words sent in one write.
+        - max_read_words is the largest amount of words read in one request.
+          Both should match the limits set on the pyxcp connection.
+        - max_gap is the largest hole between two runs that is filled to
+          merge the runs into one.
+        '''
+        self.max_words = max_words
+        self.max_read_words = max_read_words
+        self.max_gap = max_gap
+
+    def load_restore_file(self, txt_file):
+        '''
+        read a restore file made by PrepareEepFileTool.
+
+        :return pairs: list of (address, value) integers, pairs with a
+                       missing address or value are left out.
+        '''
+        pairs = []
+        for key, value in MyLibrary().read_key_value_pairs(txt_file).items():
+            if key.isdigit() and value.isdigit():
+                pairs.append((int(key), int(value)))
+        return pairs
+
+    def _write_packets(self, runs):
+        max_words = self.max_words
+        return sum(-(-length // max_words) for _, length in runs)
+
+    def _merge(self, runs, can_merge):
+        '''
+        Merges neighbouring runs where can_merge(run, next_run) is true.
+        '''
+        merged = [list(runs[0])]
+        for start, length in runs[1:]:
+            last = merged[-1]
+            if can_merge(tuple(last), (start, length)):
+                last[1] = start + length - last[0]
+            else:
+                merged.append([start, length])
+        return [tuple(run) for run in merged]
+
+    def read_spans(self, addresses):
+        '''
+        Groups sorted addresses into as few reads as possible.
+        '''
+        spans = []
+        for adr in addresses:
+            if spans and adr - spans[-1][0] < self.max_read_words:
+                spans[-1][1] = adr - spans[-1][0] + 1
+            else:
+                spans.append([adr, 1])
+        return [tuple(span) for span in spans]
+
+    def plan(self, pairs, cache=None):
+        '''
+        Plans the writes for the (address, value) pairs.
+
+        Adjacent addresses are always merged. Runs closer than max_gap are
+        merged when the words in between are known from cache (a mapping
+        of address to word, e.g. from an earlier backup) and that takes
+        no more write packets, or when reading the missing words costs
+        fewer packets than the writes it saves.
+        A later pair for the same address overrides an earlier one.
+
+        :return plan: RestorePlan
+        '''
+        values = dict(pairs)
+        cache = dict(cache) if cache else {}
+        if not values:
+            return RestorePlan([], values, cache, [], 0)
+
+        # Contiguous runs
+        runs = []
+        for adr in sorted(values):
+            if runs and adr == runs[-1][0] + runs[-1][1]:
+                runs[-1][1] += 1
+            else:
+                runs.append([adr, 1])
+
+        def gap_known(run, next_run):
+            end, start = run[0] + run[1], next_run[0]
+            if start - end > self.max_gap or not all(adr in cache for adr in range(end, start)):
+                return False
+            # Known gap words cost no reads, but must not add write packets
+            joined = (run[0], start + next_run[1] - run[0])
+            return self._write_packets([joined]) <= self._write_packets([run, next_run])
+
+        runs = self._merge(runs, gap_known)
+        packets = self._write_packets(runs)
+
+        # Try filling the remaining small gaps from the unit
+        merged = self._merge(runs, lambda run, next_run: next_run[0] - run[0] - run[1] <= self.max_gap)
+        missing = [adr for run_start, length in merged
+                   for adr in range(run_start, run_start + length)
+                   if adr not in values and adr not in cache]
+        gap_reads = self.read_spans(missing)
+
+        merged_packets = self._write_packets(merged) + len(gap_reads)
+        if merged_packets < packets:
+            return RestorePlan(merged, values, cache, gap_reads, merged_packets)
+
+        return RestorePlan(runs, values, cache, [], packets)
+
+    def execute(self, xcp, cpu_id, mem_type, plan, timeout=None, progress=None):
+        '''
+        Sends a plan to the unit through an open pyxcp connection.
+
+        progress is called as progress(words_done, words_total).
+
+        :return success: True on success, False on failure. The reason can
+                         be read with xcp.getFailureReason().
+        '''
+        cache = plan.cache
+        for start, length in plan.gap_reads:
+            words = xcp.readMemRange(cpu_id, mem_type, start, length, timeout=timeout)
+            if words is None:
+                return False
+            cache.update(zip(range(start, start + length), words))
+
+        total = plan.words()
+        done = 0
+
+        for start, length in plan.runs:
+            data = [plan.values[adr] if adr in plan.values else cache[adr]
+                    for adr in range(start, start + length)]
+
+            def run_progress(words_done, _, offset=done):
+                if progress is not None:
+                    progress(offset + words_done, total)
+
+            if not xcp.writeMemRange(cpu_id, mem_type, start, data,
+                                     timeout=timeout, progress=run_progress):
+                return False
+            done += length
+
+        return True
+
+    def restore(self, xcp, cpu_id, mem_type, txt_file, cache=None, timeout=None, progress=None):
+        '''
+        Loads, plans and sends a restore file in one go.
+
+        :return success: True on success, False on failure.
+        '''
+        plan = self.plan(self.load_restore_file(txt_file), cache)
+        return self.execute(xcp, cpu_id, mem_type, plan, timeout=timeout, progress=progress)
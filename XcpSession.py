@@ -0,0 +1,117 @@
+'''
+Delta writing EEPROM/variable sessions over XCP.
+
+A session keeps a local mirror of the words read from a unit. Writes only
+change the mirror and mark the words dirty, flush() then sends just the
+words that really differ from the unit in coalesced packets.
+'''
+from XcpRestore import XcpRestore
+
+
+class XcpSession:
+    '''
+    Cached view of one memory type on one cpu through a pyxcp connection.
+    '''
+    def __init__(self, xcp, cpu_id, mem_type, max_words=64, max_read_words=64, max_gap=8, timeout=None):
+        '''
+        - xcp is an open pyxcp connection.
+        - cpu_id and mem_type select the memory, see pyxcp.CPUID and MTYPE.
+        - max_words, max_read_words and max_gap are used to coalesce the
+          dirty words on flush, see XcpRestore.
+        '''
+        self.xcp = xcp
+        self.cpu_id = cpu_id
+        self.mem_type = mem_type
+        self.timeout = timeout
+        self._planner = XcpRestore(max_words=max_words, max_read_words=max_read_words, max_gap=max_gap)
+
+        # Words as they are on the unit, address -> word
+        self._mirror = {}
+        # Words changed locally but not yet flushed, address -> word
+        self._dirty = {}
+
+    def _fetch(self, addresses):
+        '''
+        Reads the given sorted addresses from the unit into the mirror.
+        '''
+        for start, length in self._planner.read_spans(addresses):
+            words = self.xcp.readMemRange(self.cpu_id, self.mem_type, start, length, timeout=self.timeout)
+            if words is None:
+                return False
+            self._mirror.update(zip(range(start, start + length), words))
+        return True
+
+    def read(self, adr, length, refresh=False):
+        '''
+        Reads 'length' words starting from 'adr'. Words in the mirror are
+        served without touching the serial link unless refresh is True.
+        Dirty words always return the locally written value.
+
+        :return words: list of words, None on failure
+        '''
+        addresses = range(adr, adr + length)
+        if refresh:
+            missing = list(addresses)
+        else:
+            missing = [a for a in addresses if a not in self._mirror and a not in self._dirty]
+
+        if missing and not self._fetch(missing):
+            return None
+
+        dirty = self._dirty
+        mirror = self._mirror
+        return [dirty[a] if a in dirty else mirror[a] for a in addresses]
+
+    def write(self, adr, data):
+        '''
+        Writes the words in data to adr in order, in the mirror only.
+        Words equal to what the unit already holds are not marked dirty.
+        '''
+        mirror = self._mirror
+        dirty = self._dirty
+        for a, word in enumerate(data, adr):
+            word = int(word) & 0xFFFF
+            if mirror.get(a) == word:
+                # Back to the value on the unit
+                dirty.pop(a, None)
+            else:
+                dirty[a] = word
+
+    def dirty(self):
+        '''
+        :return addresses: sorted list of addresses waiting for flush()
+        '''
+        return sorted(self._dirty)
+
+    def discard(self):
+        '''
+        Drops all local changes.
+        '''
+        self._dirty.clear()
+
+    def invalidate(self):
+        '''
+        Forgets the mirrored unit memory, next reads go to the unit.
+        '''
+        self._mirror.clear()
+
+    def flush(self, progress=None):
+        '''
+        Sends the dirty words to the unit in as few packets as possible.
+
+        :return success: True on success, False on failure. The reason can
+                         be read with xcp.getFailureReason().
+        '''
+        if not self._dirty:
+            return True
+
+        plan = self._planner.plan(self._dirty.items(), cache=self._mirror)
+        if not self._planner.execute(self.xcp, self.cpu_id, self.mem_type, plan,
+                                     timeout=self.timeout, progress=progress):
+            return False
+
+        # Gap words read while flushing are now known too
+        self._mirror.update(plan.cache)
+        self._mirror.update(self._dirty)
+        self._dirty.clear()
+        return True
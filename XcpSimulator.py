@@ -0,0 +1,434 @@
+'''
+Simulated UPS for running pyxcp without hardware.
+
+The simulator answers XCP requests like a CSB: framing and checksum,
+0xC9 memory reads and writes, 0xCF unlock and the ID block. Responses
+longer than one sequence are split with the highest bit of the sequence
+number marking the last one. Response latency, time per byte, the
+largest request and injected errors are configurable.
+
+It is used in process as a pyxcp transport:
+
+    sim = XcpSimulator(max_words=64, byte_time=10 / 115200)
+    xcp = pyxcp(None, 115200)
+    xcp.setTransport(sim)
+    xcp.setSecurityKeyProvider(simulator_key)
+
+or behind a pseudo terminal (Linux only) for code that opens a port:
+
+    xcp = pyxcp(sim.open_pty(), 115200)
+'''
+import os
+import random
+import select
+import sys
+import threading
+import time
+from array import array
+from collections import deque
+
+from pyXCP import pyxcp
+
+ERRORS = ('drop', 'checksum', 'nack', 'busy', 'truncate')
+
+# Response codes, see pyxcp._response()
+_ACCEPTED = 0x31
+_NOT_IMPLEMENTED = 0x32
+_BUSY = 0x33
+_UNRECOGNIZED = 0x34
+_OUT_OF_RANGE = 0x35
+_INVALID = 0x36
+_NACK = 0x4E
+_READ_DATA = 0x52
+_ACK = 0x57
+
+_C9_READ = 0x52
+_C9_WRITE = 0x57
+_XCP_REQID = 0x31
+_XCP_UNLOCK = 0xCF
+
+
+def _words(data):
+    words = array('H', data)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words
+
+
+def _bytes(words):
+    if sys.byteorder == 'big':
+        words = array('H', words)
+        words.byteswap()
+    return words.tobytes()
+
+
+def simulator_key(random_data, version):
+    '''
+    Unlock key of the simulator, a pure Python security key provider for
+    pyxcp.setSecurityKeyProvider().
+    '''
+    key = version & 0xFFFF
+    for word in random_data:
+        key = (((key << 1) | (key >> 15)) ^ word) & 0xFFFF
+    return key
+
+
+class XcpSimulator:
+    '''
+    In process simulated UPS with the pyserial calls pyxcp uses.
+    '''
+    def __init__(self, max_words=64, latency=0.0, byte_time=0.0, sequence_size=255,
+                 memory_words=0x10000, locked=False, key=simulator_key, id_block=b'SIMULATED UPS',
+                 error_rates=None, seed=None, timeout=0.05):
+        '''
+        - max_words is the largest read or write request accepted, larger
+          ones are answered "Parameter Out Of Range".
+        - latency is the time from a complete request to the first byte
+          of its response, byte_time the time per response byte.
+        - sequence_size is the largest payload of one response sequence.
+        - memory_words is the size of every (cpu id, memory type) memory.
+        - locked makes memory requests fail with "Negative Ack" until
+          unlocked with the key function key(random_data, version).
+        - error_rates is a dict of error name (see ERRORS) -> probability
+          per response, seed makes them repeatable.
+        - timeout is how long read() blocks when nothing is received.
+        '''
+        self.max_words = max_words
+        self.latency = latency
+        self.byte_time = byte_time
+        self.sequence_size = sequence_size
+        self.memory_words = memory_words
+        self.locked = locked
+        self.key = key
+        self.id_block = bytes(id_block)
+        self.error_rates = dict(error_rates or {})
+        self.timeout = timeout
+
+        self._random = random.Random(seed)
+        self._injected = deque()
+        self._memories = {}
+        self._expected_key = None
+
+        # Received request bytes
+        self._request = bytearray()
+
+        # Responses being sent as [first byte time, data, bytes read]
+        self._pending = deque()
+        self._condition = threading.Condition()
+
+        self._pty = None
+        self._pty_thread = None
+        self._pty_stop = threading.Event()
+
+        self.stats = {'requests': 0, 'responses': 0, 'request_bytes': 0,
+                      'response_bytes': 0, 'checksum_errors': 0, 'injected': 0}
+
+    def memory(self, cpu_id, mem_type):
+        '''
+        :return words: array('H') memory of the cpu id and memory type
+        '''
+        key = (cpu_id, mem_type)
+        words = self._memories.get(key)
+        if words is None:
+            words = array('H', bytes(2 * self.memory_words))
+            self._memories[key] = words
+        return words
+
+    def load(self, cpu_id, mem_type, adr, words):
+        '''
+        Stores words in the memory starting from adr.
+        '''
+        self.memory(cpu_id, mem_type)[adr:adr + len(words)] = array('H', words)
+
+    def inject(self, error, count=1):
+        '''
+        Makes the next count responses fail with error, see ERRORS.
+        '''
+        if error not in ERRORS:
+            raise ValueError(f'Unknown error {error}, expected one of {", ".join(ERRORS)}.')
+        self._injected.extend([error] * count)
+
+    # pyserial calls used by pyxcp
+
+    def write(self, data):
+        '''
+        Receives request bytes, complete requests are answered.
+        '''
+        data = bytes(data)
+        with self._condition:
+            self.stats['request_bytes'] += len(data)
+            self._request += data
+            self._handle_requests()
+            self._condition.notify_all()
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        with self._condition:
+            return self._available(time.perf_counter())
+
+    def read(self, size=1):
+        '''
+        Returns at most size response bytes, waits at most timeout for
+        the first one.
+        '''
+        deadline = time.perf_counter() + (self.timeout or 0.0)
+        with self._condition:
+            while True:
+                now = time.perf_counter()
+                if self._available(now):
+                    return self._take(size, now)
+
+                remaining = deadline - now
+                if remaining <= 0:
+                    return b''
+
+                # Wake up when the next byte is due or a request arrives
+                if self._pending:
+                    first, _, done = self._pending[0]
+                    remaining = min(remaining, max(0.0, first + done * self.byte_time - now))
+                self._condition.wait(remaining)
+
+    def reset_input_buffer(self):
+        with self._condition:
+            self._pending.clear()
+
+    def close(self):
+        self.close_pty()
+
+    # Responses
+
+    def _available(self, now):
+        '''
+        Amount of response bytes due by now.
+        '''
+        available = 0
+        for first, data, done in self._pending:
+            if now < first:
+                break
+            if self.byte_time > 0:
+                due = min(len(data), int((now - first) / self.byte_time) + 1)
+            else:
+                due = len(data)
+            available += due - done
+            if due < len(data):
+                break
+        return available
+
+    def _take(self, size, now):
+        out = bytearray()
+        pending = self._pending
+        while pending and len(out) < size:
+            entry = pending[0]
+            first, data, done = entry
+            if now < first:
+                break
+            if self.byte_time > 0:
+                due = min(len(data), int((now - first) / self.byte_time) + 1)
+            else:
+                due = len(data)
+
+            count = min(due - done, size - len(out))
+            out += data[done:done + count]
+            entry[2] = done + count
+            if entry[2] == len(data):
+                pending.popleft()
+            elif entry[2] == due:
+                break
+        return bytes(out)
+
+    def _send(self, data):
+        '''
+        Queues response bytes after the latency and the previous response.
+        '''
+        first = time.perf_counter() + self.latency
+        if self._pending:
+            last_first, last_data, _ = self._pending[-1]
+            first = max(first, last_first + len(last_data) * self.byte_time)
+        self._pending.append([first, data, 0])
+        self.stats['response_bytes'] += len(data)
+        self.stats['responses'] += 1
+
+    def _frame(self, payload):
+        '''
+        Splits a response payload into sequences.
+        '''
+        out = bytearray()
+        chunks = [payload[i:i + self.sequence_size]
+                  for i in range(0, len(payload), self.sequence_size)] or [b'']
+        for number, chunk in enumerate(chunks):
+            seq = number & 0x7F
+            if number == len(chunks) - 1:
+                seq |= 0x80
+            frame = bytes([pyxcp._XCP_SFD, 0, len(chunk), seq]) + chunk
+            out += frame
+            out.append(pyxcp._CHECKSUM[sum(frame) & 0xFF])
+        return out
+
+    def _next_error(self):
+        if self._injected:
+            return self._injected.popleft()
+        for error, rate in self.error_rates.items():
+            if rate > 0 and self._random.random() < rate:
+                return error
+        return None
+
+    def _respond(self, payload):
+        error = self._next_error()
+        if error is not None:
+            self.stats['injected'] += 1
+            if error == 'drop':
+                return
+            if error == 'nack':
+                payload = bytes([_NACK])
+            elif error == 'busy':
+                payload = bytes([_BUSY])
+
+        data = self._frame(payload)
+        if error == 'checksum':
+            data[-1] ^= 0xFF
+        elif error == 'truncate':
+            data = data[:len(data) // 2]
+        self._send(bytes(data))
+
+    # Requests
+
+    def _handle_requests(self):
+        '''
+        Frames and answers every complete request received.
+        '''
+        buf = self._request
+        while True:
+            start = buf.find(pyxcp._XCP_SFD)
+            if start < 0:
+                buf.clear()
+                return
+            del buf[:start]
+
+            if len(buf) < 2 or len(buf) < buf[1] + 3:
+                return
+
+            end = buf[1] + 3
+            frame = bytes(buf[:end])
+            if sum(frame) & 0xFF:
+                # Not a request, look for the next SFD
+                self.stats['checksum_errors'] += 1
+                del buf[:1]
+                continue
+            del buf[:end]
+
+            self.stats['requests'] += 1
+            self._respond(self._answer(frame[2:-1]))
+
+    def _answer(self, request):
+        '''
+        :return payload: response payload to one request
+        '''
+        if not request:
+            return bytes([_UNRECOGNIZED])
+
+        if request[0] == _XCP_REQID:
+            return bytes([_ACCEPTED]) + self.id_block
+        if request[0] == _XCP_UNLOCK:
+            return self._answer_unlock(request)
+        if request[0] != pyxcp._C9_CMD or len(request) < pyxcp._C9_MEM_HEADER.size:
+            return bytes([_UNRECOGNIZED])
+
+        if request[1] not in (_C9_READ, _C9_WRITE):
+            return bytes([_NOT_IMPLEMENTED])
+        if self.locked:
+            return bytes([_NACK])
+
+        _, command, cpu_id, mem_type, adr = pyxcp._C9_MEM_HEADER.unpack_from(request)
+        if adr & 1:
+            return bytes([_INVALID])
+        adr //= 2
+        memory = self.memory(cpu_id, mem_type)
+
+        if command == _C9_READ:
+            if len(request) < pyxcp._C9_READ_REQUEST.size:
+                return bytes([_INVALID])
+            length = pyxcp._C9_READ_REQUEST.unpack_from(request)[5] // 2
+            if length > self.max_words or adr + length > len(memory):
+                return bytes([_OUT_OF_RANGE])
+            return bytes([_READ_DATA]) + request[2:pyxcp._C9_READ_REQUEST.size] \
+                + _bytes(memory[adr:adr + length])
+
+        words = _words(request[pyxcp._C9_MEM_HEADER.size:len(request) & ~1])
+        if len(words) > self.max_words or adr + len(words) > len(memory):
+            return bytes([_OUT_OF_RANGE])
+        memory[adr:adr + len(words)] = words
+        return bytes([_ACK])
+
+    def _answer_unlock(self, request):
+        # Random data request, answered with a version and 16 random words
+        if len(request) == 4 and not any(request[1:]):
+            payload = bytes([_ACCEPTED, 0x01]) + bytes(self._random.getrandbits(8) for _ in range(32))
+            words = _words(payload)
+            self._expected_key = self.key(words[1:], words[0])
+            return payload
+
+        if self._expected_key is None or len(request) < 5:
+            return bytes([_INVALID])
+
+        key = request[3] | (request[4] << 8)
+        expected, self._expected_key = self._expected_key, None
+        if key != expected:
+            return bytes([_INVALID])
+        self.locked = False
+        return bytes([_ACCEPTED])
+
+    # Pseudo terminal
+
+    def open_pty(self):
+        '''
+        Serves the simulator on a pseudo terminal, Linux only.
+
+        :return port: name of the port to open, e.g. /dev/pts/3
+        '''
+        import tty
+
+        if self._pty is not None:
+            return os.ttyname(self._pty[1])
+
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        self._pty = (master, slave)
+        self._pty_stop.clear()
+        self._pty_thread = threading.Thread(target=self._serve_pty, name='XcpSimulator pty', daemon=True)
+        self._pty_thread.start()
+        return os.ttyname(slave)
+
+    def close_pty(self):
+        '''
+        Stops serving the pseudo terminal.
+        '''
+        if self._pty is None:
+            return
+        self._pty_stop.set()
+        self._pty_thread.join()
+        for fd in self._pty:
+            os.close(fd)
+        self._pty = None
+        self._pty_thread = None
+
+    def _serve_pty(self):
+        master = self._pty[0]
+        while not self._pty_stop.is_set():
+            # Wake up when the next response byte is due
+            wait = 0.01
+            with self._condition:
+                if self._pending:
+                    first, _, done = self._pending[0]
+                    wait = min(wait, max(0.0, first + done * self.byte_time - time.perf_counter()))
+
+            readable, _, _ = select.select([master], [], [], wait)
+            if readable:
+                self.write(os.read(master, 4096))
+
+            with self._condition:
+                now = time.perf_counter()
+                available = self._available(now)
+                data = self._take(available, now) if available else b''
+            if data:
+                os.write(master, data)
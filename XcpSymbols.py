@@ -0,0 +1,142 @@
+'''
+Symbolic variable map for XCP reads by name.
+
+A symbol file is a CSV file with the columns
+
+    name, cpu_id, mem_type, address, length, scale, offset, signed
+
+cpu_id and mem_type may be numbers or names from pyxcp.CPUID and
+pyxcp.MTYPE. length (words, default 1), scale (default 1), offset
+(default 0) and signed (default 0) are optional. Values are decoded as
+raw * scale + offset, two word values are combined low word first.
+
+Reading a list of names is compiled once into the fewest readMem calls
+and reused for later reads of the same list.
+'''
+import csv
+from collections import namedtuple
+
+from pyXCP import pyxcp
+
+Symbol = namedtuple('Symbol', ['name', 'cpu_id', 'mem_type', 'address', 'length', 'scale', 'offset', 'signed'])
+
+
+class XcpSymbols:
+    '''
+    Loaded symbol map with batch reads by name.
+    '''
+    def __init__(self, xcp=None, product='93PM', max_gap=8):
+        '''
+        - xcp is an open pyxcp connection, needed for reading only.
+        - product selects the cpu id names, see pyxcp.CPUID.
+        - max_gap is the largest hole between two symbols that is read
+          along to merge their requests.
+        '''
+        self.xcp = xcp
+        self.product = product
+        self.max_gap = max_gap
+        self.symbols = {}
+        self._batches = {}
+
+    def _number(self, value, names):
+        value = str(value).strip()
+        if value in names:
+            return names[value]
+        return int(value, 0)
+
+    def add(self, name, cpu_id, mem_type, address, length=1, scale=1, offset=0, signed=False):
+        '''
+        Adds one symbol. cpu_id and mem_type may be given by name.
+        '''
+        symbol = Symbol(
+            name,
+            self._number(cpu_id, pyxcp.CPUID.get(self.product, {})),
+            self._number(mem_type, pyxcp.MTYPE),
+            self._number(address, {}),
+            int(length or 1),
+            float(scale or 1),
+            float(offset or 0),
+            str(signed).strip().lower() in ('1', 'true', 'yes'))
+        self.symbols[name] = symbol
+        self._batches.clear()
+
+    def load(self, csv_file):
+        '''
+        read a symbol CSV file, see module doc for the columns.
+
+        :return symbols: amount of symbols loaded
+        '''
+        with open(csv_file, 'r', encoding='utf-8', newline='') as file:
+            rows = [row for row in csv.DictReader(file)
+                    if row.get('name') and not row['name'].strip().startswith('#')]
+
+        for row in rows:
+            self.add(row['name'].strip(), row['cpu_id'], row['mem_type'], row['address'],
+                     row.get('length'), row.get('scale'), row.get('offset'), row.get('signed'))
+        return len(rows)
+
+    def compile(self, names):
+        '''
+        Plans the reads of a list of names.
+
+        :return requests: list of (cpu_id, mem_type, start, length,
+                          [(name, offset, symbol)])
+        '''
+        key = tuple(names)
+        batch = self._batches.get(key)
+        if batch is not None:
+            return batch
+
+        max_words = self.xcp.getLinkSettings()['maxReadWords'] if self.xcp is not None else 64
+        symbols = sorted((self.symbols[name] for name in set(names)),
+                         key=lambda s: (s.cpu_id, s.mem_type, s.address))
+
+        batch = []
+        for symbol in symbols:
+            if batch:
+                cpu_id, mem_type, start, length, members = batch[-1]
+                end = max(start + length, symbol.address + symbol.length)
+                if (cpu_id, mem_type) == (symbol.cpu_id, symbol.mem_type) \
+                        and symbol.address - (start + length) <= self.max_gap \
+                        and end - start <= max_words:
+                    members.append((symbol.name, symbol.address - start, symbol))
+                    batch[-1] = (cpu_id, mem_type, start, end - start, members)
+                    continue
+            batch.append((symbol.cpu_id, symbol.mem_type, symbol.address, symbol.length,
+                          [(symbol.name, 0, symbol)]))
+
+        self._batches[key] = batch
+        return batch
+
+    def _decode(self, words, symbol):
+        if symbol.length > 2:
+            if symbol.scale == 1 and symbol.offset == 0:
+                return list(words)
+            return [word * symbol.scale + symbol.offset for word in words]
+
+        raw = words[0] if symbol.length == 1 else words[0] | (words[1] << 16)
+        if symbol.signed:
+            bits = 16 * symbol.length
+            if raw >> (bits - 1):
+                raw -= 1 << bits
+
+        if symbol.scale == 1 and symbol.offset == 0:
+            return raw
+        return raw * symbol.scale + symbol.offset
+
+    def read_named(self, names):
+        '''
+        Reads the given symbols with as few requests as possible.
+
+        :return values: dict of name to value, None on failure. The reason
+                        can be read with xcp.getFailureReason().
+        '''
+        values = {}
+        for cpu_id, mem_type, start, length, members in self.compile(names):
+            words = self.xcp.readMemRange(cpu_id, mem_type, start, length)
+            if words is None:
+                return None
+
+            for name, offset, symbol in members:
+                values[name] = self._decode(words[offset:offset + symbol.length], symbol)
+        return values
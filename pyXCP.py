@@ -10,15 +10,434 @@ date: 2014-04-01
 
 Relies on pyserial for serial communication.
 
-Updated to python3 syntax on 2016-03-01. Uses lists to build packets which
-are then before sending converted to bytes. Whole class could be re written
-to use bytes.
+Updated to python3 syntax on 2016-03-01. Memory requests are packed with
+struct straight into a preallocated transmit buffer and sent with a single
+write when no byte pacing is used.
 """
 
 import serial
+import struct
 import time
+import bisect
 import ctypes
 import random
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+from array import array
+from collections import deque
+
+_log = logging.getLogger("pyxcp")
+
+# NumPy is optional, only needed for readMem(..., wordFormat = "numpy")
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class _xcpFrameParser:
+    '''
+    Incremental parser for XCP response sequences.
+
+    Received bytes are appended to one reusable buffer with feed(), and
+    complete sequences are taken out with nextSequence(). The parser keeps
+    its state between calls, so a sequence may arrive in any number of
+    pieces.
+    '''
+
+    # Parser states
+    _STATE_SFD = 0
+    _STATE_HEADER = 1
+    _STATE_PAYLOAD = 2
+
+    # SFD, block number, length and sequence number
+    _HEADER_LENGTH = 4
+
+    def __init__(self, sfd):
+        self._sfd = sfd
+        self._buffer = bytearray()
+        self._state = self._STATE_SFD
+        self._length = 0
+        return
+
+    def feed(self, data):
+        '''
+        Appends received bytes to the buffer.
+        '''
+        self._buffer += data
+        return
+
+    def clear(self):
+        '''
+        Drops all buffered bytes and any partially received sequence.
+        '''
+        del self._buffer[:]
+        self._state = self._STATE_SFD
+        return
+
+    def pending(self):
+        '''
+        Returns the amount of buffered bytes not yet parsed.
+        '''
+        return len(self._buffer)
+
+    def nextSequence(self):
+        '''
+        Parses the next sequence from the buffer.
+
+        Returns a tuple (blockNum, length, seqNum, payload) when a whole
+        sequence is available, None if more bytes are needed and False if
+        a sequence was dropped because of a checksum error.
+        '''
+        buf = self._buffer
+
+        if self._state == self._STATE_SFD:
+            start = buf.find(self._sfd)
+            if start < 0:
+                # Only garbage in buffer
+                del buf[:]
+                return None
+
+            # Drop everything before the SFD
+            if start > 0:
+                del buf[:start]
+            self._state = self._STATE_HEADER
+
+        if self._state == self._STATE_HEADER:
+            if len(buf) < self._HEADER_LENGTH:
+                return None
+            self._length = buf[2]
+            self._state = self._STATE_PAYLOAD
+
+        # Payload is followed by the checksum
+        end = self._HEADER_LENGTH + self._length + 1
+        if len(buf) < end:
+            return None
+
+        blockNum = buf[1]
+        seqNum = buf[3]
+        payload = bytes(buf[self._HEADER_LENGTH:end - 1])
+        checksumOk = (sum(buf[:end]) & 0xFF) == 0
+
+        # Sequence consumed, start looking for the next one
+        del buf[:end]
+        self._state = self._STATE_SFD
+
+        if not checksumOk:
+            return False
+
+        return (blockNum, self._length, seqNum, payload)
+
+
+class _rangeCheckpoint:
+    '''
+    Completed ranges of a bulk read, kept on disk so that an interrupted
+    read can continue where it stopped. Words are stored in 'path' and the
+    request and completed ranges in 'path'.json.
+    '''
+
+    def __init__(self, path, request, length):
+        self._path = path
+        self._infoPath = path + ".json"
+        self._request = dict(request, length = length, byteorder = sys.byteorder)
+        self.words = array('H', bytes(2 * length))
+        self.done = []
+
+        resume = False
+        if os.path.exists(path) and os.path.exists(self._infoPath):
+            with open(self._infoPath, "r") as infoFile:
+                info = json.load(infoFile)
+            resume = info.get("request") == self._request
+
+        if resume:
+            self._file = open(path, "r+b")
+            self.words = array('H', self._file.read(2 * length))
+            self.done = [tuple(r) for r in info["done"]]
+        else:
+            self._file = open(path, "w+b")
+            self._file.truncate(2 * length)
+        return
+
+    def isDone(self, start, end):
+        '''
+        Returns True if words start..end-1 have already been read.
+        '''
+        for doneStart, doneEnd in self.done:
+            if doneStart <= start and end <= doneEnd:
+                return True
+        return False
+
+    def complete(self, start, end):
+        '''
+        Stores words start..end-1 and marks them read.
+        '''
+        self._file.seek(2 * start)
+        self._file.write(self.words[start:end].tobytes())
+        self._file.flush()
+
+        # Merge the range with its neighbours
+        ranges = sorted(self.done + [(start, end)])
+        self.done = [ranges[0]]
+        for rangeStart, rangeEnd in ranges[1:]:
+            lastStart, lastEnd = self.done[-1]
+            if rangeStart <= lastEnd:
+                self.done[-1] = (lastStart, max(lastEnd, rangeEnd))
+            else:
+                self.done.append((rangeStart, rangeEnd))
+
+        # Replace the info in one go so a crash cannot leave half a file
+        tmpPath = self._infoPath + ".tmp"
+        with open(tmpPath, "w") as infoFile:
+            json.dump({"request": self._request, "done": self.done}, infoFile)
+        os.replace(tmpPath, self._infoPath)
+        return
+
+    def close(self):
+        self._file.close()
+        return
+
+    def remove(self):
+        '''
+        Deletes the checkpoint files once the read is complete.
+        '''
+        self.close()
+        os.remove(self._path)
+        if os.path.exists(self._infoPath):
+            os.remove(self._infoPath)
+        return
+
+
+class _rttEstimator:
+    '''
+    Response time estimator in the style of TCP (RFC 6298).
+
+    Keeps a smoothed latency from request to the first response sequence
+    and its variation, plus the observed time per received byte. Request
+    timeouts are set from these and the expected response size.
+    '''
+
+    # Gains and variation multiplier from RFC 6298
+    _ALPHA = 0.125
+    _BETA = 0.25
+    _K = 4
+
+    # Largest multiplier of backed off timeouts
+    _MAX_BACKOFF = 64
+
+    def __init__(self, baud, fallback = 2, minSamples = 4, minTimeout = 0.02):
+        '''
+        - baud is used for the nominal time per byte (10 bits per byte).
+        - fallback is the timeout used until minSamples have been seen.
+        - minTimeout is the smallest timeout ever given.
+        '''
+        self.nominalByteTime = 10.0 / baud
+        self.byteTime = self.nominalByteTime
+        self.fallback = fallback
+        self.minSamples = minSamples
+        self.minTimeout = minTimeout
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+        self.backoff = 1
+        return
+
+    def addSample(self, latency, firstBytes, restTime = 0.0, restBytes = 0):
+        '''
+        Adds one response.
+
+        - latency is the time from request to complete first sequence,
+          firstBytes its size. The transfer time of it is subtracted.
+        - restTime is the time it took to receive restBytes after the
+          first sequence.
+        '''
+        latency = max(0.0, latency - firstBytes * self.byteTime)
+
+        # After timeouts the old estimate is no good, start over (RFC 6298 5.7)
+        if self.srtt == None or self.backoff > 1:
+            self.srtt = latency
+            self.rttvar = latency / 2
+            self.backoff = 1
+        else:
+            self.rttvar += self._BETA * (abs(self.srtt - latency) - self.rttvar)
+            self.srtt += self._ALPHA * (latency - self.srtt)
+
+        # Devices may pause between sequences, never assume faster than baud
+        if restBytes > 0:
+            byteTime = max(self.nominalByteTime, restTime / restBytes)
+            self.byteTime += self._ALPHA * (byteTime - self.byteTime)
+
+        self.samples += 1
+        return
+
+    def timedOut(self):
+        '''
+        Doubles the timeout after a request timed out (RFC 6298 5.5), up
+        to the fallback. Kept until the next response is received.
+        '''
+        if self.samples >= self.minSamples:
+            self.backoff = min(2 * self.backoff, self._MAX_BACKOFF)
+        return
+
+    def timeout(self, expectedBytes = 0):
+        '''
+        Returns the timeout for a response of expectedBytes, counted from
+        the request. Returns None while there are too few samples.
+        '''
+        if self.samples < self.minSamples:
+            return None
+
+        # Transfer time gets the same headroom as the latency
+        rto = self.srtt + self._K * self.rttvar + 2 * expectedBytes * self.byteTime
+        rto = max(self.minTimeout, rto)
+
+        if self.backoff > 1:
+            rto = max(rto, min(rto * self.backoff, self.fallback))
+        return rto
+
+
+class _xcpMetrics:
+    '''
+    Traffic counters and response time histograms of one connection.
+    '''
+
+    # Histogram bucket upper limits in seconds, the last bucket is open
+    _BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0)
+
+    def __init__(self, logInterval = None):
+        '''
+        - logInterval, if given, logs a summary line to the "pyxcp"
+          logger at most every logInterval seconds.
+        '''
+        self.start = time.perf_counter()
+        self.logInterval = logInterval
+        self._nextLog = self.start + logInterval if logInterval else None
+
+        self.txPackets = 0
+        self.txBytes = 0
+        self.rxSequences = 0
+        self.rxBytes = 0
+        self.failures = {}
+        self.responses = {}
+        self.pacingTime = 0.0
+        self.firstByte = [0] * (len(self._BUCKETS) + 1)
+        self.response = [0] * (len(self._BUCKETS) + 1)
+        self.firstByteTotal = 0.0
+        self.responseTotal = 0.0
+        return
+
+    def addTx(self, length):
+        self.txPackets += 1
+        self.txBytes += length
+        return
+
+    def addFailure(self, reason):
+        self.failures[reason] = self.failures.get(reason, 0) + 1
+        return
+
+    def addResponse(self, response, sequences = 0, length = 0, firstByte = None, total = None):
+        '''
+        Adds one response, its text as given by pyxcp._response().
+        firstByte is the time from the request until its first bytes were
+        received and total until the last one.
+        '''
+        self.responses[response] = self.responses.get(response, 0) + 1
+        self.rxSequences += sequences
+        self.rxBytes += length
+
+        if firstByte != None:
+            self.firstByte[bisect.bisect_left(self._BUCKETS, firstByte)] += 1
+            self.firstByteTotal += firstByte
+        if total != None:
+            self.response[bisect.bisect_left(self._BUCKETS, total)] += 1
+            self.responseTotal += total
+
+        if self._nextLog != None and time.perf_counter() >= self._nextLog:
+            self._nextLog = time.perf_counter() + self.logInterval
+            _log.info(self.summary())
+        return
+
+    def _histogram(self, counts):
+        limits = list(self._BUCKETS) + [None]
+        return [(limit, count) for limit, count in zip(limits, counts)]
+
+    def snapshot(self):
+        '''
+        Returns the metrics as a dict.
+        '''
+        elapsed = time.perf_counter() - self.start
+        firstTimed = sum(self.firstByte)
+        timed = sum(self.response)
+        return {
+            "seconds": elapsed,
+            "txPackets": self.txPackets,
+            "txBytes": self.txBytes,
+            "rxSequences": self.rxSequences,
+            "rxBytes": self.rxBytes,
+            "checksumErrors": self.failures.get("Checksum Error", 0),
+            "timeouts": self.failures.get("Timeout", 0),
+            "failures": dict(self.failures),
+            "responses": dict(self.responses),
+            "firstByteHistogram": self._histogram(self.firstByte),
+            "responseHistogram": self._histogram(self.response),
+            "meanFirstByte": self.firstByteTotal / firstTimed if firstTimed else None,
+            "meanResponse": self.responseTotal / timed if timed else None,
+            "pacingTime": self.pacingTime,
+            "pacingShare": self.pacingTime / elapsed if elapsed > 0 else 0.0
+            }
+
+    def summary(self):
+        '''
+        Returns the main metrics as one line of text.
+        '''
+        snap = self.snapshot()
+        meanResponse = snap["meanResponse"]
+        return "tx {} packets {} bytes, rx {} sequences {} bytes, {} timeouts, " \
+               "{} checksum errors, mean response {}, pacing {:.0%}".format(
+                   snap["txPackets"], snap["txBytes"], snap["rxSequences"], snap["rxBytes"],
+                   snap["timeouts"], snap["checksumErrors"],
+                   "-" if meanResponse == None else "{:.1f} ms".format(meanResponse * 1000),
+                   snap["pacingShare"])
+
+
+class _dllKeyProvider:
+    '''
+    Security key provider backed by the vendor DLL.
+
+    The DLL is loaded and its GetKey prototype set up on first use only,
+    later keys are a single foreign call.
+    '''
+
+    _RandomData = ctypes.c_ushort * 16
+
+    def __init__(self, dllName = "mm1167sp.dll"):
+        self.dllName = dllName
+        self._getKey = None
+        return
+
+    def _load(self):
+        keydll = ctypes.WinDLL(self.dllName)
+        getKey = keydll.GetKey
+        getKey.argtypes = [ctypes.POINTER(self._RandomData), ctypes.c_ushort]
+        getKey.restype = ctypes.c_ushort
+        self._getKey = getKey
+        return getKey
+
+    def __call__(self, randomData, version):
+        getKey = self._getKey
+        if getKey == None:
+            getKey = self._load()
+
+        dataFromCsb = self._RandomData(*randomData[:16])
+        return getKey(ctypes.byref(dataFromCsb), version)
+
+
+# Shared by all connections so the DLL is loaded once per process
+_defaultKeyProvider = _dllKeyProvider()
+
 
 class pyxcp(serial.Serial):
     '''
@@ -117,6 +536,10 @@ class pyxcp(serial.Serial):
             }
         }
 
+    # Broadcast cpu ids, answered by several cpus: 93PM "all", "AllUPMs",
+    # "AllUPMPLDs" and "AllUPMBootloaders"
+    _BROADCAST_CPUIDS = frozenset((0, 56, 57, 58))
+
     # memType constants, accessed as MEMTYPE["93PM"]["var"]
     MEMTYPE = {
         "93PM": {
@@ -154,19 +577,61 @@ class pyxcp(serial.Serial):
         "boot": 6
         }
 
+    # Largest amount of words one C9 request may carry, accessed as MAXWORDS["93PM"].
+    # 9395P limit is what the service tool uses to read meters.
+    MAXWORDS = {
+        "93PM": 64,
+        "9395P": 42
+        }
+
+    # Pacing waits are slept until this close to the deadline and spun
+    # the rest. Grows if the OS oversleeps more than this, up to a whole
+    # 15.6 ms timer tick of older Pythons on Windows. Waits shorter than
+    # the margin are spun completely.
+    _SPIN_MARGIN = 0.0005
+    _MAX_SPIN_MARGIN = 0.05
+
+    # Pacing waits sleep at most this long at a time when metrics are
+    # collected, to see when the response starts arriving
+    _RX_POLL_INTERVAL = 0.001
+
     _XCP_SFD = 0xAB
+    _XCP_MAX_PAYLOAD = 255
+
+    # SFD, block number, length, sequence number and checksum
+    _XCP_SEQUENCE_OVERHEAD = 5
+
+    # Function code, cpu id, memory type, address and length
+    _C9_READ_RESPONSE_HEADER = 11
     _C9_CMD = 0xC9
     _C9_NACK = 0x4E
+
+    # Two's complement checksum, indexed by the low byte of the packet sum
+    _CHECKSUM = bytes((-i) & 0xFF for i in range(256))
+
+    # Precompiled packet layouts. All XCP fields are little endian.
+    _XCP_HEADER = struct.Struct("<BB")
+    _C9_MEM_HEADER = struct.Struct("<BBBBI")
+    _C9_READ_REQUEST = struct.Struct("<BBBBII")
+    _C9_READ_RESPONSE = struct.Struct("<BBBII")
+
+    # Word payloads for every size that fits in one C9 write packet
+    _WORD_STRUCTS = tuple(struct.Struct("<%dH" % n) for n in range((255 - 8) // 2 + 1))
   
-    def __init__(self, port, baud, txByteWait = 0.0, xcpWait = 0.1, **kwargs):
+    def __init__(self, port, baud, txByteWait = 0.0, xcpWait = 0.1, txChunkSize = 1, maxWords = 64, **kwargs):
         '''
         - txByteDelay sets how long to wait in between every sent byte.
         - xcpWait is the minimum time the code waits in between packets
           before sending the next packet.
+        - txChunkSize is the amount of bytes written in one go before
+          waiting txByteWait. Only used when txByteWait is not zero.
+        - maxWords is the largest amount of words read or written in one
+          request by readMemRange() and writeMemRange(). See MAXWORDS.
           
         This is to overcome CSB receive speed limitations. If CSB for some
         reson seems to hang or not answer, make txByteWait longer (40ms is
-        a good guess).
+        a good guess). XcpCalibration can find and store the fastest
+        reliable settings per port and cpu id instead.
         '''
         serial.Serial.__init__(self, port=port, baudrate=baud, **kwargs)
         
@@ -175,9 +640,47 @@ class pyxcp(serial.Serial):
         
         self._txByteWait = txByteWait
         self._xcpWait = xcpWait
+        self._txChunkSize = max(1, int(txChunkSize))
+        self.setMaxReadWords(maxWords)
+        self.setMaxWriteWords(maxWords)
+
+        # Packets are encoded in place here: SFD, length, payload, checksum
+        self._txBuffer = bytearray(self._XCP_HEADER.size + self._XCP_MAX_PAYLOAD + 1)
 
         # This is for trying to be smart with giving CSB its required time
-        self._lastWrite = time.time()
+        self._lastWrite = time.perf_counter()
+        self._spinMargin = self._SPIN_MARGIN
+
+        # Work to be done during the next pacing wait
+        self._waitWork = deque()
+
+        # Received bytes are framed into sequences here
+        self._rxParser = _xcpFrameParser(self._XCP_SFD)
+
+        # Response times, used when no fixed timeout is given
+        self._rtt = _rttEstimator(baud)
+
+        # Read responses must echo the cpu id, see setCheckCpuId()
+        self._checkCpuId = False
+
+        # Traffic metrics, see enableMetrics()
+        self._metrics = None
+
+        # When the first bytes after the last request were received
+        self._firstRxTime = None
+
+        # Replaces the serial port when set, see setTransport()
+        self._transport = None
+
+        # Unlock state, see ensureUnlocked()
+        self._keyProvider = None
+        self._unlocked = False
+
+        # Optional background receiver, see startReceiver()
+        self._receiver = None
+        self._receiverStop = threading.Event()
+        self._rxQueue = queue.Queue()
+        self._rxLock = threading.Lock()
 
         self._lastFailure = "No failures has occured"
         return
@@ -196,114 +699,434 @@ class pyxcp(serial.Serial):
         self._xcpWait = delay
         return
 
+    def setTxChunkSize(self, size):
+        '''
+        Sets the amount of bytes written between every txByteWait.
+        '''
+        self._txChunkSize = max(1, int(size))
+        return
+
+    def setMaxReadWords(self, words):
+        '''
+        Sets the largest amount of words requested in one read.
+        '''
+        self._maxReadWords = max(1, int(words))
+        return
+
+    def setMaxWriteWords(self, words):
+        '''
+        Sets the largest amount of words sent in one write. Limited by
+        the 255 byte XCP payload.
+        '''
+        self._maxWriteWords = max(1, min(int(words), len(self._WORD_STRUCTS) - 1))
+        return
+
+    def getLinkSettings(self):
+        '''
+        Returns the current pacing and request size settings as a
+        dictionary.
+        '''
+        return {
+            "txByteWait": self._txByteWait,
+            "xcpWait": self._xcpWait,
+            "txChunkSize": self._txChunkSize,
+            "maxReadWords": self._maxReadWords,
+            "maxWriteWords": self._maxWriteWords
+            }
+
+    def setCheckCpuId(self, check):
+        '''
+        Makes readMem() also reject responses whose cpu id differs from
+        the request. Off by default, responses are matched by address and
+        length only.
+        '''
+        self._checkCpuId = check
+        return
+
+    def enableMetrics(self, logInterval = None):
+        '''
+        Starts counting packets, bytes, failures and responses and
+        timing responses and pacing waits, see getMetrics(). Counting
+        starts over if already enabled.
+
+        logInterval, if given, logs a summary line to the "pyxcp" logger
+        at most every logInterval seconds.
+        '''
+        self._metrics = _xcpMetrics(logInterval)
+        return
+
+    def disableMetrics(self):
+        '''
+        Stops collecting metrics.
+        '''
+        self._metrics = None
+        return
+
+    def getMetrics(self):
+        '''
+        Returns a snapshot dict of the metrics, None if not enabled.
+
+        Includes packet and byte counts per direction, timeouts, checksum
+        errors, failures and responses by reason, histograms of the time
+        to the first received byte and to the complete response as
+        (upper limit in seconds, count) with None for the open bucket, and
+        the time and share of time spent in pacing waits. Response times
+        are counted from the request, the pacing wait after it is part of
+        them as well as of the pacing time.
+        '''
+        if self._metrics == None:
+            return None
+        return self._metrics.snapshot()
+
+    def setTransport(self, transport):
+        '''
+        Sends and receives through transport instead of the serial port,
+        e.g. an XcpSimulator. Open with port None to not use a real port:
+
+            xcp = pyxcp(None, 115200)
+            xcp.setTransport(XcpSimulator())
+
+        transport needs the pyserial calls write(data), read(size),
+        in_waiting and reset_input_buffer(). read() should block at most
+        about the serial timeout when nothing is received. None goes back
+        to the serial port.
+        '''
+        self._transport = transport
+        return
+
+    def resync(self, quiet = None):
+        '''
+        Drops everything received so far, including the rest of a failed
+        response, so the next read starts from a fresh SFD.
+
+        quiet is how long to wait for late bytes first. By default the
+        current (backed off) response timeout, at least 0.05 seconds.
+        '''
+        if quiet == None:
+            quiet = max(0.05, self._rtt.timeout(self._XCP_MAX_PAYLOAD + self._XCP_SEQUENCE_OVERHEAD) or 0.0)
+        time.sleep(quiet)
+        if self._transport != None:
+            self._transport.reset_input_buffer()
+        else:
+            self.reset_input_buffer()
+
+        with self._rxLock:
+            self._rxParser.clear()
+            self._clearRxQueue()
+        return
+
+    def _clearRxQueue(self):
+        while True:
+            try:
+                self._rxQueue.get_nowait()
+            except queue.Empty:
+                return
+
+    def startReceiver(self, queueSize = 64):
+        '''
+        Starts a thread that keeps reading the serial port and framing the
+        received sequences into a queue of at most queueSize sequences.
+        read() and readMem() then take complete sequences from the queue,
+        so the port is drained even while the caller is busy.
+
+        When the queue is full the thread keeps reading but leaves the
+        bytes unframed until there is room again.
+        '''
+        if self._receiver != None:
+            return
+
+        self._rxQueue = queue.Queue(maxsize = queueSize)
+        self._receiverStop.clear()
+        self._receiver = threading.Thread(target = self._receiveLoop, name = "pyxcp receiver", daemon = True)
+        self._receiver.start()
+        return
+
+    def stopReceiver(self):
+        '''
+        Stops the receiver thread. Sequences already in the queue are
+        still returned by the following reads.
+        '''
+        if self._receiver == None:
+            return
+
+        self._receiverStop.set()
+        self._receiver.join()
+        self._receiver = None
+        return
+
+    def _receiveLoop(self):
+        '''
+        Receiver thread body.
+        '''
+        parser = self._rxParser
+        rxQueue = self._rxQueue
+
+        while not self._receiverStop.is_set():
+            data = self._readSerial()
+            if data and self._firstRxTime == None:
+                self._firstRxTime = time.perf_counter()
+
+            with self._rxLock:
+                parser.feed(data)
+
+                while not rxQueue.full():
+                    seq = parser.nextSequence()
+                    if seq == None:
+                        break
+                    rxQueue.put_nowait(seq)
+        return
+
+    def close(self):
+        '''
+        Stops the receiver thread, if running, and closes the port.
+        '''
+        # Close may be called by serial.Serial.__init__ before our setup
+        if getattr(self, "_receiver", None) != None:
+            self.stopReceiver()
+        serial.Serial.close(self)
+        return
+
     def _calculateChecksum(self, data):
         '''
         Calculate the two's complement checksum used in the XCP protocol.
         '''
-        checksum = 0
-        for byte in data:
-            checksum = (checksum + (~byte) + 1) & 0xFF
-        return checksum
+        return self._CHECKSUM[sum(data) & 0xFF]
 
     def write(self, data):
         '''
         Write one packet over XCP. Encapsulates packet in XCP headers.
 
-        Max payload is 255 bytes. Fails in _writeSerial if is bigger.
+        Max payload is 255 bytes. Raises ValueError if is bigger.
         '''
         # Don't write non-existant data
         if len(data) < 1:
             return
 
+        if len(data) > self._XCP_MAX_PAYLOAD:
+            raise ValueError("Maximum payload is {} bytes.".format(self._XCP_MAX_PAYLOAD))
+
+        # Copy payload in place and send it
+        start = self._XCP_HEADER.size
+        self._txBuffer[start:start + len(data)] = data
+        self._transmit(len(data))
+        return
+
+    def _transmit(self, length):
+        '''
+        Encapsulates the payload already placed in the transmit buffer
+        and sends it as one packet.
+        '''
         # Wait the CSB processing time
-        while (time.time() - self._lastWrite) < self._xcpWait:
-            continue
+        self._waitForPacing()
 
         # Add encapsulation
-        encapData = [self._XCP_SFD, len(data)] + data
-        encapData.append( self._calculateChecksum(encapData) )
+        buf = self._txBuffer
+        end = self._XCP_HEADER.size + length
+        self._XCP_HEADER.pack_into(buf, 0, self._XCP_SFD, length)
+
+        view = memoryview(buf)
+        buf[end] = self._CHECKSUM[sum(view[:end]) & 0xFF]
 
         # Send it
-        self._writeSerial(encapData)
-        
+        self._writeSerial(view[:end + 1])
+
+        if self._metrics != None:
+            self._metrics.addTx(end + 1)
+
         # Store time when last written to
-        self._lastWrite = time.time() 
+        self._lastWrite = time.perf_counter()
+        self._firstRxTime = None
+        return
+
+    def runDuringWait(self, work):
+        '''
+        Queues a callable that is run at the start of the next pacing wait,
+        e.g. decoding the previous response while the CSB processes the
+        request. Work longer than the wait delays the next packet.
+        '''
+        self._waitWork.append(work)
+        return
+
+    def runQueuedWork(self):
+        '''
+        Runs the work queued with runDuringWait() right away.
+        '''
+        work = self._waitWork
+        while work:
+            work.popleft()()
+        return
+
+    def _waitForPacing(self):
+        '''
+        Waits until xcpWait has passed since the last write. Queued work
+        is run first, then the wait is slept until just before the
+        deadline and the final part is spun for accuracy. With metrics the
+        port is polled during the wait for the first response bytes.
+        '''
+        metrics = self._metrics
+        if metrics != None:
+            waitStart = time.perf_counter()
+
+        self.runQueuedWork()
+
+        deadline = self._lastWrite + self._xcpWait
+        while True:
+            remaining = deadline - time.perf_counter() - self._spinMargin
+            if remaining <= 0:
+                break
+            if metrics != None:
+                remaining = min(remaining, self._RX_POLL_INTERVAL)
+
+            sleepStart = time.perf_counter()
+            time.sleep(remaining)
+
+            # Learn how much the OS oversleeps so the deadline is not missed
+            overshoot = time.perf_counter() - sleepStart - remaining
+            if overshoot > self._spinMargin:
+                self._spinMargin = min(overshoot * 1.5, self._MAX_SPIN_MARGIN)
+
+            if metrics != None:
+                self._stampFirstRx()
+
+        while time.perf_counter() < deadline:
+            continue
+
+        if metrics != None:
+            self._stampFirstRx()
+            metrics.pacingTime += time.perf_counter() - waitStart
+        return
+
+    def _stampFirstRx(self):
+        if self._firstRxTime == None and self._bytesWaiting():
+            self._firstRxTime = time.perf_counter()
         return
 
     def _writeSerial(self, data):
         '''
-        Writes a list of bytes to the serial port.
+        Writes bytes to the serial port.
         Slows down writes if _txByteWait is not zero since it seems
         that the CSB cannot process data sent at full speed.
         '''
+        if self._transport != None:
+            write = self._transport.write
+        else:
+            write = self._writePort
 
-        # Convert list to bytes
-        data = bytes(data)
-        
-        for byte in data:
-            serial.Serial.write(self, [byte])
-            
-            # It seems the CSB cannot receive data fast enough in some cases.
-            if self._txByteWait != 0:
-                time.sleep(self._txByteWait)
+        if self._txByteWait == 0:
+            write(data)
+            return
+
+        # It seems the CSB cannot receive data fast enough in some cases.
+        chunkSize = self._txChunkSize
+        for i in range(0, len(data), chunkSize):
+            write(data[i:i + chunkSize])
+            time.sleep(self._txByteWait)
         return
 
+    def _writePort(self, data):
+        return serial.Serial.write(self, data)
+
     
     def _readSerial(self):
         '''
-        Tries to read one byte from serial port.
+        Reads whatever the serial port holds. Blocks at most the serial
+        timeout if nothing has been received. Returns the bytes read.
         '''
-        # Read one byte and convert to int
-        byte = int.from_bytes( serial.Serial.read(self, 1), "big")
+        transport = self._transport
+        if transport != None:
+            return transport.read(max(1, transport.in_waiting))
+        return serial.Serial.read(self, max(1, self.in_waiting))
 
-        return byte
-
-    def _readXCPSequence(self, timeout = 2):
+    def _bytesWaiting(self):
         '''
-        Reads a raw XCP response, only one sequence. Checksum is checked.
-        Returns none if checksum fails or start delimiter is not found.
+        Returns the amount of received bytes not read yet.
+        '''
+        if self._transport != None:
+            return self._transport.in_waiting
+        return self.in_waiting
 
-        This routine can be used directly to read responses, but it is
-        reccomended to use read() as it handles packet merging and
-        response checking aswell.
+    def _nextSequence(self, timeout):
+        '''
+        Returns the next sequence from the receive buffer as a tuple
+        (blockNum, length, seqNum, payload), reading more from the serial
+        port as needed. Returns None on timeout or checksum error.
         '''
-        # Find SFD
+        if self._receiver != None or not self._rxQueue.empty():
+            return self._nextQueuedSequence(timeout)
+
         startTime = time.time()
+        drained = False
         while True:
-            if time.time() - startTime > timeout:
-                self._lastFailure = "Timeout"
+            seq = self._rxParser.nextSequence()
+
+            if seq:
+                return seq
+
+            if seq is False:
+                self._lastFailure = "Checksum Error"
                 return None
 
-            if self._readSerial() == self._XCP_SFD:
-                break # SFD found!
-        
-        # Read header information
-        blockNum = self._readSerial()
-        length   = self._readSerial()
-        seqNum   = self._readSerial()
+            # Give bytes already waiting in the port one last chance
+            if time.time() - startTime > timeout:
+                if drained or not self._bytesWaiting():
+                    self._lastFailure = "Timeout"
+                    return None
+                drained = True
 
-        # Receive payload
-        recData = []
-        for i in range(length):
-            recData.append( self._readSerial() )
+            data = self._readSerial()
+            if data and self._firstRxTime == None:
+                self._firstRxTime = time.perf_counter()
+            self._rxParser.feed(data)
 
-        # Receive checksum
-        checksum = self._readSerial()
+    def _nextQueuedSequence(self, timeout):
+        '''
+        _nextSequence() for sequences framed by the receiver thread.
+        '''
+        try:
+            if self._receiver != None:
+                seq = self._rxQueue.get(timeout = max(0, timeout))
+            else:
+                seq = self._rxQueue.get_nowait()
+        except queue.Empty:
+            self._lastFailure = "Timeout"
+            return None
 
-        # Checksum match?
-        if self._calculateChecksum([self._XCP_SFD, blockNum, length, seqNum] + recData) != checksum:
+        if seq is False:
             self._lastFailure = "Checksum Error"
             return None
 
+        return seq
+
+    def _readXCPSequence(self, timeout = 2):
+        '''
+        Reads a raw XCP response, only one sequence. Checksum is checked.
+        Returns none if checksum fails or start delimiter is not found.
+
+        This routine can be used directly to read responses, but it is
+        reccomended to use read() as it handles packet merging and
+        response checking aswell.
+        '''
+        seq = self._nextSequence(timeout)
+
+        if seq == None:
+            return None
+
+        blockNum, length, seqNum, payload = seq
+
         # Build a dictionary for easy parsing
-        return {"blockNum":blockNum, "length":length, "seqNum": seqNum, "data":recData}
+        return {"blockNum":blockNum, "length":length, "seqNum": seqNum, "data":list(payload)}
 
-    def read(self, timeout = 2):
+    def read(self, timeout = None, expectedBytes = 0):
         '''
         Reads a XCP response, takes sequence numbers into acount and merges
         them into one big packet. Returns None in case of error. Error reason
         can be read with getFailureReason().
 
+        If timeout is given every sequence may take that long. If None, the
+        whole response must arrive within a timeout estimated from earlier
+        response times and expectedBytes (see getRttEstimate()). Until
+        there are enough samples, 2 seconds per sequence is used.
+
         Notes:
 
         93PM implementation doesn't seem to follow XCP spec very strictly. For
@@ -318,38 +1141,108 @@ class pyxcp(serial.Serial):
         fails, the amount of words received will not match the requested amount.
         That can be used to check for successful reads.
         '''
+        data = self._readResponse(timeout, expectedBytes)
+
+        if data == None:
+            return None
+
+        return list(data)
+
+    def _readResponse(self, timeout = None, expectedBytes = 0, estimate = True):
+        '''
+        read() without the conversion to a list, returns the payload of the
+        response as a bytearray. estimate False keeps the response time
+        out of the response time estimate.
+        '''
         lastSequenceFound = False
+        requestTime = self._lastWrite
 
         # Wait the CSB processing time
-        while (time.time() - self._lastWrite) < self._xcpWait:
-            continue
+        self._waitForPacing()
+
+        deadline = None
+        if timeout == None:
+            rto = self._rtt.timeout(expectedBytes)
+            if rto == None:
+                timeout = self._rtt.fallback
+            else:
+                deadline = requestTime + rto
 
         # Store received data here
-        recData = []
+        recData = bytearray()
+        firstTime = None
+        sequences = 0
 
         # Receive all data
         while not lastSequenceFound:
-            seq = self._readXCPSequence(timeout = timeout)
+            if deadline != None:
+                timeout = deadline - time.perf_counter()
+            seq = self._nextSequence(timeout)
 
             # No valid data received, something has gone wrong
             if seq == None:
+                if deadline != None and self._lastFailure == "Timeout":
+                    self._rtt.timedOut()
+                if self._metrics != None:
+                    self._metrics.addFailure(self._lastFailure)
                 return None
 
+            blockNum, length, seqNum, payload = seq
+
             # Check for ok response in first packet.
-            if len(recData) == 0:
-                if not self._operationSuccessful( seq["data"][0] ):
-                    self._lastFailure = self._response( seq["data"][0] )
+            if firstTime == None:
+                firstTime = time.perf_counter()
+                firstBytes = len(payload) + self._XCP_SEQUENCE_OVERHEAD
+
+                firstByte = firstTime if self._firstRxTime == None else self._firstRxTime
+                firstByte -= requestTime
+
+                funcCode = payload[0] if payload else None
+                if not self._operationSuccessful(funcCode):
+                    self._lastFailure = self._response(funcCode)
+                    # The device is assumed to have locked again
+                    if funcCode == self._C9_NACK:
+                        self._unlocked = False
+                    if self._metrics != None:
+                        self._metrics.addResponse(self._lastFailure, 1, firstBytes, firstByte)
                     return None
 
             # Check for last sequence number (highest bit set)
-            if seq["seqNum"] & 0x80:
+            if seqNum & 0x80:
                 lastSequenceFound = True
 
             # Add received data to other data
-            recData += seq["data"]
-        
+            recData += payload
+            sequences += 1
+
+        endTime = time.perf_counter()
+        restBytes = len(recData) + self._XCP_SEQUENCE_OVERHEAD * sequences - firstBytes
+        if estimate:
+            self._rtt.addSample(firstTime - requestTime, firstBytes,
+                                endTime - firstTime, restBytes)
+
+        if self._metrics != None:
+            self._metrics.addResponse(self._response(funcCode), sequences, firstBytes + restBytes,
+                                      firstByte, endTime - requestTime)
         return recData
 
+    def getRttEstimate(self):
+        '''
+        Returns the current response time estimate as a dictionary:
+        smoothed latency, its variation, time per byte, amount of samples,
+        the backoff multiplier after timeouts and the timeout currently
+        used for a one sequence response (None while the fixed fallback is
+        in use).
+        '''
+        return {
+            "srtt": self._rtt.srtt,
+            "rttvar": self._rtt.rttvar,
+            "byteTime": self._rtt.byteTime,
+            "samples": self._rtt.samples,
+            "backoff": self._rtt.backoff,
+            "timeout": self._rtt.timeout(self._XCP_MAX_PAYLOAD + self._XCP_SEQUENCE_OVERHEAD)
+            }
+
     def getFailureReason(self):
         '''
         Returns a human readable reason for the last failure.
@@ -443,7 +1336,7 @@ class pyxcp(serial.Serial):
         return
 
 
-    def writeMem(self, cpuId, memType, adr, data, timeout = 2):
+    def writeMem(self, cpuId, memType, adr, data, timeout = None):
         '''
         Writes the words in data to adr in order.
         
@@ -451,45 +1344,47 @@ class pyxcp(serial.Serial):
         memType defines what memory is to be read.
         See CPUID and MEMTYPE definitions at beginning of class.
 
-        Returns True on success, False on failure
+        Returns True on success, False on failure. Without timeout the ack
+        is waited for the fixed fallback time of read(), the receive
+        buffer is resynchronised after a failure.
 
-        TODO: Automate the maximum amount of words to send.
-        93PM seems to accept at most 64 words.
-        9395P limit seems to be 42? At least that is what the
-        service tool uses to read meters.
+        At most setMaxWriteWords() words can be sent at once, 64 by
+        default. See MAXWORDS for known device limits and use
+        writeMemRange() for bigger writes.
         '''
         if len(data) == 0:
             return
 
-        if len(data) > 64:
-            self._lastFailure = "Maximum write size is 64."
+        if len(data) > self._maxWriteWords:
+            self._lastFailure = "Maximum write size is {}.".format(self._maxWriteWords)
             return False
 
         C9_WRITE = 0x57
 
-        # Build header
-        c9op = [self._C9_CMD, C9_WRITE, cpuId & 0xFF, memType & 0xFF]
-
-        # Add address. Split it into bytes
-        adr *= 2
-        c9op.append(adr >> 0  & 0xFF)
-        c9op.append(adr >> 8  & 0xFF)
-        c9op.append(adr >> 16 & 0xFF)
-        c9op.append(adr >> 24 & 0xFF)
+        # Build header, address is given in bytes
+        header = self._C9_MEM_HEADER
+        start = self._XCP_HEADER.size
+        header.pack_into(self._txBuffer, start,
+                         self._C9_CMD, C9_WRITE, cpuId & 0xFF, memType & 0xFF,
+                         (adr * 2) & 0xFFFFFFFF)
 
         # Add the data 
-        for word in data:
-            word = int(word)
-            c9op.append(word >> 0 & 0xFF)
-            c9op.append(word >> 8 & 0xFF)
+        self._WORD_STRUCTS[len(data)].pack_into(self._txBuffer, start + header.size,
+                                                *[int(word) & 0xFFFF for word in data])
 
         # Write eeproms
-        self.write(c9op)
-
-        # Check result
-        data = self.read(timeout)
+        self._transmit(header.size + 2 * len(data))
+
+        # Check result. The ack does not tell which write it is for and
+        # the memory write takes longer than a read, so it gets the fixed
+        # timeout and is kept out of the read estimate
+        if timeout == None:
+            timeout = self._rtt.fallback
+        data = self._readResponse(timeout, estimate = False)
         
         if data == None:
+            # A late ack must not be taken for the answer to the next write
+            self.resync()
             return False
                 
         return True
@@ -504,25 +1399,14 @@ class pyxcp(serial.Serial):
 
         C9_READ = 0x52
 
-        # Build header
-        c9op = [self._C9_CMD, C9_READ, cpuId & 0xFF, memType & 0xFF]
-
-        # Add address
-        adr *= 2
-        c9op.append(adr >> 0  & 0xFF)
-        c9op.append(adr >> 8  & 0xFF)
-        c9op.append(adr >> 16 & 0xFF)
-        c9op.append(adr >> 24 & 0xFF)
-
-        # Add number of bytes
-        length *= 2
-        c9op.append(length >> 0  & 0xFF)
-        c9op.append(length >> 8  & 0xFF)
-        c9op.append(length >> 16 & 0xFF)
-        c9op.append(length >> 24 & 0xFF)
+        # Build request, address and length are given in bytes
+        request = self._C9_READ_REQUEST
+        request.pack_into(self._txBuffer, self._XCP_HEADER.size,
+                          self._C9_CMD, C9_READ, cpuId & 0xFF, memType & 0xFF,
+                          (adr * 2) & 0xFFFFFFFF, (length * 2) & 0xFFFFFFFF)
 
         # Send packet
-        self.write(c9op)
+        self._transmit(request.size)
         return
 
     
@@ -530,84 +1414,248 @@ class pyxcp(serial.Serial):
         '''
         Combines a list consisting of bytes pairwise to words.
         '''
-        wordsStr = []
-        for i in range(0, len(bytesStr)-1, 2):
-            wordsStr.append(bytesStr[i] | (bytesStr[i+1] << 8) )
-        return wordsStr
+        return self._bytesToWordArray(bytes(bytesStr[:len(bytesStr) & ~1])).tolist()
 
+    def _bytesToWordArray(self, data):
+        '''
+        Converts little endian bytes to array('H') in one go.
+        '''
+        words = array('H')
+        words.frombytes(data)
 
-    def readMem(self, cpuId, memType, start, length, timeout = 2):
+        if sys.byteorder == "big":
+            words.byteswap()
+        return words
+
+
+    def readMem(self, cpuId, memType, start, length, timeout = None, wordFormat = "list"):
         '''
         Reads 'length' amount of memory startging from 'start'.
-        Returns read words. Returns None on failure.
+        Returns read words. Returns None on failure, the receive buffer is
+        then resynchronised.
+
+        Without timeout the response time estimate is used, see read().
+
+        wordFormat selects what the words are returned as:
+        - "list": list of ints.
+        - "array": array('H').
+        - "memoryview": memoryview of format 'H' over the received bytes,
+          no copy is made. On big endian hosts an array('H') is returned.
+        - "numpy": numpy uint16 array over the received bytes, no copy is
+          made. Needs NumPy.
         '''
         # Send read request
         self._readFromMemRequest(cpuId, memType, start, length)
         
         # Read response
-        data = self.read(timeout = timeout)
+        data = self._readMemResponse(length, timeout)
+
+        # Broadcasts are answered by the member cpus
+        checkCpuId = self._checkCpuId and cpuId not in self._BROADCAST_CPUIDS
+        if data != None and self._checkMemResponse(data, cpuId if checkCpuId else None, start, length):
+            words = self._decodeMemResponse(data, length, wordFormat)
+            if words != None:
+                return words
+
+        # Drop the rest of the response, or a late answer to an earlier
+        # request, so the next request starts clean. Only as long as this
+        # response could still take
+        self.resync(self._rtt.timeout(self._memResponseBytes(length)))
+        return None
+
+    def _memResponseBytes(self, length):
+        '''
+        Returns the size of the response to a read of 'length' words.
+        '''
+        payload = self._C9_READ_RESPONSE_HEADER + 2 * length
+        sequences = -(-payload // self._XCP_MAX_PAYLOAD)
+        return payload + sequences * self._XCP_SEQUENCE_OVERHEAD
 
-        if data == None:
-            return None
+    def _readMemResponse(self, length, timeout = None):
+        '''
+        Reads the raw response to a read memory request of 'length' words.
+        '''
+        return self._readResponse(timeout = timeout, expectedBytes = self._memResponseBytes(length))
 
-        # Decode packet header, not used for anything (yet atleast)
-        r_funcCode = data[0]
-        r_cpuId = data[1]
-        r_memType = data[2]
+    def _checkMemResponse(self, data, cpuId, adr, length):
+        '''
+        Returns True if the header of a raw read memory response matches
+        a request of 'length' words at 'adr' to cpuId. cpuId None accepts
+        an answer from any cpu.
+        '''
+        if len(data) < self._C9_READ_RESPONSE.size:
+            self._lastFailure = "Received incomplete read memory response"
+            return False
 
-        r_adr    = ( (data[3] << 0) | (data[4] << 8) | (data[5] << 16) | (data[6]  << 24) ) / 2
-        r_length = ( (data[7] << 0) | (data[8] << 8) | (data[9] << 16) | (data[10] << 24) ) / 2
+        _, r_cpuId, _, r_adr, r_length = self._C9_READ_RESPONSE.unpack_from(data)
 
-        # Combine bytes into words
-        words = self._combineBytesToWords( data[11:] )
+        if (cpuId != None and r_cpuId != cpuId & 0xFF) or \
+           r_adr != (adr * 2) & 0xFFFFFFFF or r_length != (length * 2) & 0xFFFFFFFF:
+            self._lastFailure = "Response from cpu {} for address {} length {} does not match the request".format(
+                r_cpuId, r_adr // 2, r_length // 2)
+            return False
+        return True
 
+    def _decodeMemResponse(self, data, length, wordFormat = "list"):
+        '''
+        Returns the words of a raw read memory response, None if it does
+        not hold 'length' words. See readMem() for wordFormat.
+        '''
         # Check if received words match the requested amount. Due C9 read memory request
         # shortcomings in 93PM the "NACK" answer cannot be used to reliably detect faults
         # in multi-packet answers from the UPS.
-        if len(words) != length:
+        received = (len(data) - self._C9_READ_RESPONSE_HEADER) // 2
+        if received != length:
             # Probably got NACK late in the read
-            self._lastFailure = "Received incorrect amount of words ({} of {})".format(len(words), length)
+            self._lastFailure = "Received incorrect amount of words ({} of {})".format(received, length)
             return None
-        
+
+        # Combine bytes into words
+        start = self._C9_READ_RESPONSE_HEADER
+        payload = memoryview(data)[start:start + 2 * length]
+
+        if wordFormat == "numpy":
+            if numpy == None:
+                raise ValueError("wordFormat \"numpy\" needs NumPy.")
+            return numpy.frombuffer(data, dtype = "<u2", count = length, offset = start)
+
+        if wordFormat == "memoryview" and sys.byteorder == "little":
+            return payload.cast('H')
+
+        words = self._bytesToWordArray(payload)
+
+        if wordFormat == "list":
+            return words.tolist()
         return words
 
-    def _getSecurityKey(self, randomData, version):
+    def readMemRange(self, cpuId, memType, start, length, timeout = None, progress = None,
+                     retries = 3, checkpoint = None, onChunk = None):
         '''
-        Returns security key. Expects DLL to be in same directory.
+        Reads 'length' amount of memory starting from 'start', split into
+        requests of at most setMaxReadWords() words. Returns the words as
+        array('H'). Returns None on failure.
+
+        progress is called as progress(wordsDone, wordsTotal) after every
+        request. onChunk is called as onChunk(adr, words) with the words of
+        every request as they arrive, e.g. for streaming them to disk.
+
+        A failed request is retried up to 'retries' times, after dropping
+        the rest of the failed response. If checkpoint is a file path the
+        completed requests are saved there, and a later call for the same
+        range continues from where an interrupted read stopped. The
+        checkpoint files are removed when the read completes.
+        '''
+        saved = None
+        if checkpoint != None:
+            request = {"cpuId": cpuId, "memType": memType, "start": start}
+            saved = _rangeCheckpoint(checkpoint, request, length)
+            words = saved.words
+        else:
+            words = array('H', bytes(2 * length))
+
+        done = 0
+        try:
+            while done < length:
+                count = min(self._maxReadWords, length - done)
+
+                if saved == None or not saved.isDone(done, done + count):
+                    chunk = self._readMemRetry(cpuId, memType, start + done, count, timeout, retries)
+                    if chunk == None:
+                        return None
+
+                    words[done:done + count] = chunk
+                    if saved != None:
+                        saved.complete(done, done + count)
+
+                if onChunk != None:
+                    onChunk(start + done, words[done:done + count])
+
+                done += count
+
+                if progress != None:
+                    progress(done, length)
+        finally:
+            if saved != None:
+                saved.close()
+
+        if saved != None:
+            saved.remove()
 
-        This is only for panda platform.
+        return words
+
+    def _readMemRetry(self, cpuId, memType, adr, length, timeout, retries):
+        '''
+        readMem() with up to 'retries' retries. readMem() resynchronises
+        the receive buffer after a failure, waiting out the backed off
+        response timeout so a late response is not taken for the retry.
         '''
-        keydll = ctypes.WinDLL("mm1167sp.dll")
+        for attempt in range(retries + 1):
+            words = self.readMem(cpuId, memType, adr, length, timeout = timeout, wordFormat = "array")
+            if words != None:
+                return words
 
-        RandomDataStruct = ctypes.c_ushort * 16
-        keydll.GetKey.argtypes = [ctypes.POINTER(RandomDataStruct), ctypes.c_ushort]
-        keydll.GetKey.restype = ctypes.c_ushort
+        self._lastFailure = "Read failed at address {} after {} retries: {}".format(
+            adr, retries, self._lastFailure)
+        return None
 
-        dataFromCsb = RandomDataStruct()
-        # Copy data to c-type list
-        for i in range(len(randomData)):
-            dataFromCsb[i] = randomData[i];
+    def writeMemRange(self, cpuId, memType, adr, data, timeout = None, progress = None):
+        '''
+        Writes the words in data to adr in order, split into requests of
+        at most setMaxWriteWords() words.
 
-        return keydll.GetKey(ctypes.byref(dataFromCsb), version)
+        Returns True on success, False on failure. Words before the failed
+        request have been written.
 
-    def unlock(self):
+        progress is called as progress(wordsDone, wordsTotal) after every
+        request.
         '''
-        Tries to unlock the XCP protocol. Returns True on success, False otherwise.
+        length = len(data)
+        done = 0
+
+        while done < length:
+            count = min(self._maxWriteWords, length - done)
+
+            if not self.writeMem(cpuId, memType, adr + done, data[done:done + count], timeout = timeout):
+                self._lastFailure = "Write failed at address {}: {}".format(adr + done, self._lastFailure)
+                return False
+            done += count
+
+            if progress != None:
+                progress(done, length)
+
+        return True
+
+    def _getSecurityKey(self, randomData, version):
+        '''
+        Returns security key. Expects DLL to be in same directory.
 
         This is only for panda platform.
         '''
-        # Sequence to request random data        
-        self.write( [0xcf, 0x00, 0x00, 0x00] )
-        data = self.read(timeout = 1)
+        provider = self._keyProvider
+        if provider == None:
+            provider = _defaultKeyProvider
 
-        # Nothing received or error occured
-        if data == None:
-            return False
-        
+        return provider(randomData, version)
+
+    def setSecurityKeyProvider(self, provider):
+        '''
+        Sets the function computing the unlock key, called as
+        provider(randomData, version) with 16 random words and returning
+        the 16 bit key. None restores the DLL (mm1167sp.dll) provider,
+        which only exists on Windows.
+        '''
+        self._keyProvider = provider
+        return
+
+    def _unlockAnswer(self, data):
+        '''
+        Builds the unlock completion packet from the random data response.
+        Returns None if the response is too short.
+        '''
         # Payload should be 34 bytes
         if len(data) < 34:
             self._lastFailure = "Received incorrect amount of random data."
-            return False
+            return None
 
         words = self._combineBytesToWords(data)
         key = self._getSecurityKey(words[1:], words[0])
@@ -624,12 +1672,72 @@ class pyxcp(serial.Serial):
         c9op[3] = (key >> 0) & 0xFF
         c9op[4] = (key >> 8) & 0xFF
 
+        return c9op
+
+    def unlock(self):
+        '''
+        Tries to unlock the XCP protocol. Returns True on success, False otherwise.
+
+        This is only for panda platform.
+        '''
+        self._unlocked = False
+
+        # Sequence to request random data        
+        self.write( [0xcf, 0x00, 0x00, 0x00] )
+        data = self.read(timeout = 1)
+
+        # Nothing received or error occured
+        if data == None:
+            return False
+
+        c9op = self._unlockAnswer(data)
+        if c9op == None:
+            return False
+
         # And send answer
         self.write(c9op)
         response = self.read(timeout = 1)
 
         if response != None:
             if self._response( response[0] ) == "Accepted":
+                self._unlocked = True
                 return True
         
         return False
+
+    def isUnlocked(self):
+        '''
+        Returns True if the last unlock succeeded and no request has been
+        negatively acknowledged since.
+        '''
+        return self._unlocked
+
+    def ensureUnlocked(self):
+        '''
+        Unlocks only if not already unlocked. Returns True on success,
+        False otherwise.
+        '''
+        if self._unlocked:
+            return True
+        return self.unlock()
+
+    def runUnlocked(self, operation, *args, **kwargs):
+        '''
+        Runs operation(*args, **kwargs) on an unlocked session, e.g.
+        runUnlocked(xcp.writeMemRange, cpuId, memType, adr, data).
+
+        Unlocks first if needed. If the operation fails with a negative
+        acknowledge the session is unlocked again and the operation
+        retried once. Returns the result of the operation, None if the
+        unlock failed.
+        '''
+        if not self.ensureUnlocked():
+            return None
+
+        result = operation(*args, **kwargs)
+        if (result is None or result is False) and not self._unlocked:
+            if not self.unlock():
+                return None
+            result = operation(*args, **kwargs)
+
+        return result